@@ -1,4 +1,4 @@
 from client import SearchClient
-from document import Term, Document
+from document import Term, Document, DetachedDocument
 from errors import *
 from queries import *
@@ -0,0 +1,238 @@
+# Copyright (c) 2010 Richard Boulton
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+r"""Building a database in parallel, as a set of shards.
+
+The documents are split between several worker processes, each of which
+processes its share of the documents and writes them to its own database (a
+"shard").  The shards may then be compacted into a single database, or kept
+as a set of databases to be searched together.
+
+All changes to the schema are made in the parent process, by guessing the
+handling of new fields before documents are passed to the workers, so every
+shard ends up with the same schema, and with the same slot allocations.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import multiprocessing
+import os
+import Queue
+import shutil
+import tempfile
+import zlib
+
+import multisearch.errors
+from multisearch.backends.xapian_backend.client import Schema, \
+     WritableSearchClient
+from multisearch import utils
+import xapian
+
+def build_sharded(path, docs, shards, compact=True, batch_size=1000,
+                  max_pending=None, assume_new=False, client_args=None):
+    """Build a database from a sequence of documents, in parallel.
+
+    `docs` is an iterable of (docid, doc) pairs, as for update_many().  IDs are
+    allocated for documents with a docid of None.  Each document is sent to a
+    shard chosen from a hash of its ID, so if an ID is repeated the documents
+    with that ID are written to the same shard, in the order supplied.
+
+    `shards` worker processes are used, each writing one shard.  Documents are
+    sent to the workers in batches of up to `batch_size` documents, and at
+    most `max_pending` batches (by default, 2) are queued for each worker.
+
+    If `compact` is True, the shards are built in a temporary directory
+    alongside `path`, and then compacted into a single database at `path`,
+    which must not already exist.  Otherwise, the shards are left in
+    subdirectories of `path`.  Either way, returns a list of the paths of the
+    resulting databases: these can be passed as the path to a readonly
+    SearchClient.
+
+    `assume_new` is passed to update_many() in each worker, and
+    `client_args` may be a dictionary of extra arguments to use when opening
+    the shards (for example, a commit policy).
+
+    """
+    if max_pending is None:
+        max_pending = 2
+    if client_args is None:
+        client_args = {}
+    if compact:
+        if os.path.exists(path):
+            raise multisearch.errors.SearchClientError(
+                "Destination for compacted database (%r) already exists" %
+                path)
+        shard_dir = tempfile.mkdtemp(prefix=os.path.basename(path) + '.',
+                                     dir=os.path.dirname(path) or '.')
+    else:
+        shard_dir = path
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+    shard_paths = [os.path.join(shard_dir, 'shard%03d' % i)
+                   for i in xrange(shards)]
+
+    try:
+        schema = _build_shards(shard_paths, docs, batch_size, max_pending,
+                               assume_new, client_args)
+        if not compact:
+            return shard_paths
+        compact_databases(shard_paths, path)
+        db = xapian.WritableDatabase(path, xapian.DB_OPEN)
+        db.set_metadata("__ms:schema", schema.serialise())
+        db.commit()
+        return [path]
+    finally:
+        if compact:
+            shutil.rmtree(shard_dir)
+
+def compact_databases(sources, dest):
+    """Compact a set of databases into a single new database.
+
+    """
+    if hasattr(xapian.Database, 'compact'):
+        db = xapian.Database()
+        for source in sources:
+            db.add_database(xapian.Database(source))
+        db.compact(dest)
+    elif hasattr(xapian, 'Compactor'):
+        compactor = xapian.Compactor()
+        for source in sources:
+            compactor.add_source(source)
+        compactor.set_destdir(dest)
+        compactor.compact()
+    else:
+        raise multisearch.errors.FeatureNotAvailableError(
+            "This version of Xapian doesn't support compacting databases")
+
+def shard_for_docid(docid, shards):
+    """Get the shard number which a document ID is assigned to.
+
+    """
+    return (zlib.crc32(docid) & 0xffffffff) % shards
+
+def _build_shards(shard_paths, docs, batch_size, max_pending, assume_new,
+                  client_args):
+    """Feed documents to a worker process for each shard.
+
+    Returns the final schema.
+
+    """
+    shards = len(shard_paths)
+    schema = Schema()
+    if client_args.get('data_codec') is not None:
+        # The workers' schemas are replaced by this one, so the codec must be
+        # set here.
+        schema.set_data_codec(client_args['data_codec'])
+    alloc = utils.TimeOrderedDocidAllocator()
+    queues = [multiprocessing.Queue(max_pending) for i in xrange(shards)]
+    workers = [multiprocessing.Process(target=_shard_worker,
+                                       args=(shard_path, queue, assume_new,
+                                             client_args))
+               for shard_path, queue in zip(shard_paths, queues)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        # The serialised schema last sent to each worker.
+        sent = [None] * shards
+        serialised = None
+        revision = None
+        for batch in utils.iter_batches(docs, batch_size):
+            items = [[] for i in xrange(shards)]
+            for docid, doc in batch:
+                docid = alloc() if docid is None else str(docid)
+                fields = list(utils.iter_doc_fields(doc))
+                for fieldname, value in fields:
+                    schema.guess(fieldname, value)
+                items[shard_for_docid(docid, shards)].append((docid, fields))
+
+            if serialised is None or revision != schema.revision:
+                serialised = schema.serialise()
+                revision = schema.revision
+            for shard in xrange(shards):
+                if not items[shard]:
+                    continue
+                _send(workers[shard], queues[shard], serialised, sent, shard,
+                      items[shard])
+
+        serialised = schema.serialise()
+        for shard in xrange(shards):
+            if sent[shard] != serialised:
+                _send(workers[shard], queues[shard], serialised, sent, shard,
+                      [])
+            _put(workers[shard], queues[shard], shard, None)
+    except:
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+
+    for shard_path, worker in zip(shard_paths, workers):
+        if worker.exitcode != 0:
+            raise multisearch.errors.BackendError(
+                "Worker building shard %r failed (exit code %r)" %
+                (shard_path, worker.exitcode))
+    return schema
+
+def _send(worker, queue, serialised, sent, shard, items):
+    """Send a batch of items to a worker, with the schema if it has changed.
+
+    """
+    if sent[shard] == serialised:
+        _put(worker, queue, shard, (None, items))
+    else:
+        _put(worker, queue, shard, (serialised, items))
+        sent[shard] = serialised
+
+def _put(worker, queue, shard, msg):
+    """Put a message on a worker's queue, waiting while the queue is full.
+
+    Raises BackendError if the worker stops while waiting.
+
+    """
+    while True:
+        if not worker.is_alive():
+            raise multisearch.errors.BackendError(
+                "Worker building shard %d has stopped (exit code %r)" %
+                (shard, worker.exitcode))
+        try:
+            queue.put(msg, timeout=1)
+            return
+        except Queue.Full:
+            pass
+
+def _shard_worker(shard_path, queue, assume_new, client_args):
+    """Write the documents sent to a worker process to its shard.
+
+    """
+    client = WritableSearchClient(shard_path, **client_args)
+    while True:
+        msg = queue.get()
+        if msg is None:
+            break
+        serialised, items = msg
+        if serialised is not None:
+            schema = Schema.unserialise(serialised)
+            schema.mark_modified()
+            client._set_schema(schema)
+        for docid in client.update_many(items, assume_new=assume_new):
+            pass
+    client.close()
@@ -22,6 +22,9 @@ r"""Xapian backend.
 """
 __docformat__ = "restructuredtext en"
 
+import array
+import base64
+import time
 from multisearch.utils.closed import ClosedObject
 import multisearch.backends.xapian_backend.errors
 from multisearch.backends.xapian_backend.types_blob import XapianBlobIndexer, XapianBlobQueryGenerator
@@ -29,6 +32,10 @@ from multisearch.backends.xapian_backend.types_text import XapianTextIndexer, Xa
 from multisearch.backends.xapian_backend.types_float import XapianFloatIndexer, XapianFloatQueryGenerator
 from multisearch.backends.xapian_backend.xquery import XapianQuery
 from multisearch.backends.xapian_backend.operators import _opmap
+from multisearch.backends.xapian_backend.filtercache import FilterCache, \
+     DocidSet
+from multisearch.backends.xapian_backend.postingsources import \
+     DocidSetPostingSource, DocidRangePostingSource, DeadlinePostingSource
 import multisearch.client
 import multisearch.errors
 import multisearch.queries
@@ -60,6 +67,9 @@ class Schema(JsonSchema):
     # Schema version that this class creates.
     SCHEMA_FORMAT_VERSION = 1
 
+    # The value slot reserved for holding document IDs.
+    DOCID_SLOT = 0xfffffffe
+
     @classmethod
     def register_type(cls, name, doc, indexer, querygen):
         cls.known_types[name] = (doc, indexer, querygen)
@@ -69,6 +79,16 @@ class Schema(JsonSchema):
         self.append_guesser(DefaultGuesser())
         self.next_slot = 0
 
+        # The value slot which document IDs are stored in, or None if they
+        # are only stored as terms (as in databases created before IDs were
+        # stored in a slot).
+        self.docid_slot = self.DOCID_SLOT
+
+        # The codec used to encode the stored data of new documents (see
+        # multisearch.utils.datacodec).  Data is decoded according to its
+        # format, so this can be changed at any time.
+        self.data_codec = 'json'
+
     @classmethod
     def unserialise(cls, value):
         """Load the schema from json.
@@ -91,6 +111,8 @@ class Schema(JsonSchema):
             m = __import__(module_name, fromlist=[name], level=0)
             result.append_guesser(getattr(m, name)(**kwargs))
         result.next_slot = schema['next_slot']
+        result.docid_slot = schema.get('docid_slot')
+        result.data_codec = schema.get('data_codec', 'json')
         result.modified = False
         return result
 
@@ -104,9 +126,53 @@ class Schema(JsonSchema):
             routes=self.routes,
             guessers=[g.serialise() for g in self.guessers],
             next_slot = self.next_slot,
+            docid_slot = self.docid_slot,
+            data_codec = self.data_codec,
         )
         return json.dumps(schema, sort_keys=True)
 
+    @classmethod
+    def merge(cls, schemas):
+        """Combine the schemas of several databases which are searched
+        together.
+
+        Raises SearchClientError if the schemas are incompatible: that is, if a
+        field has different types or parameters, or an incoming field has
+        different routes, in different schemas, or if a value slot is used
+        for different fields in different schemas.
+
+        """
+        schemas = list(schemas)
+        result = cls.unserialise(schemas[0].serialise())
+        for schema in schemas[1:]:
+            for attr in ('fieldtypes', 'routes'):
+                merged = getattr(result, attr)
+                for key, value in getattr(schema, attr).iteritems():
+                    if merged.setdefault(key, value) != value:
+                        raise multisearch.errors.SearchClientError(
+                            "Incompatible schemas: field %r is configured "
+                            "differently in different databases" % (key, ))
+            result.next_slot = max(result.next_slot, schema.next_slot)
+            if result.docid_slot != schema.docid_slot:
+                # Fall back to reading document IDs from the termlist.
+                result.docid_slot = None
+
+        # Each value slot must hold the values of only one field, or sorting
+        # and range queries on a field would see the other field's values.
+        slots = {}
+        for fieldname, (type, params) in sorted(result.fieldtypes.iteritems()):
+            slot = params.get('slot')
+            if slot is None:
+                continue
+            other = slots.setdefault(int(slot), fieldname)
+            if other != fieldname:
+                raise multisearch.errors.SearchClientError(
+                    "Incompatible schemas: fields %r and %r both use value "
+                    "slot %d in different databases" % (other, fieldname,
+                                                        int(slot)))
+        result.modified = False
+        return result
+
     def prefix_from_fieldname(self, fieldname):
         return 'X' + ''.join(c.upper() for c in fieldname if c.isalnum())
 
@@ -128,10 +194,94 @@ class Schema(JsonSchema):
         type, params = self.get(fieldname)
         return self.known_types[type][2](fieldname, params)
 
+    def set_data_codec(self, codec):
+        """Set the codec used to encode the stored data of new documents.
+
+        Raises ValueError if the codec isn't known.
+
+        """
+        utils.datacodec.check_codec(codec)
+        self.check_modifiable()
+        if codec != self.data_codec:
+            self.data_codec = codec
+            self.mark_modified()
+
     def alloc_slot(self):
+        self.check_modifiable()
         self.next_slot += 1
+        self.mark_modified()
         return self.next_slot - 1
 
+class IndexingPlan(object):
+    """A compiled plan for processing incoming documents with a schema.
+
+    This maps each incoming field name to the indexers to apply to its values,
+    so that processing a field of a document needs only a dictionary lookup.
+    A single indexer instance is kept for each destination field, and reused
+    for every document.  Since the type of a field can't be changed once set,
+    the indexers remain valid for the life of the schema; the routes are
+    discarded and rebuilt whenever the schema's revision changes.
+
+    """
+    def __init__(self, schema):
+        self.schema = schema
+        self.revision = schema.revision
+        self.indexers = {}
+        self.routes = {}
+
+    def indexer(self, fieldname):
+        """Get the indexer for a destination field.
+
+        """
+        idx = self.indexers.get(fieldname, None)
+        if idx is None:
+            self.indexers[fieldname] = idx = self.schema.indexer(fieldname)
+        return idx
+
+    def get_route(self, fieldname, value):
+        """Get the indexers for an incoming field.
+
+        Returns a sequence of (indexer, route_params) pairs.  If the field is
+        not known, `value` is used to guess how to handle it.
+
+        """
+        schema = self.schema
+        if self.revision != schema.revision:
+            self.routes = {}
+            self.revision = schema.revision
+        route = self.routes.get(fieldname, None)
+        if route is None:
+            schema.guess(fieldname, value)
+            route = tuple((self.indexer(destfield), route_params)
+                          for destfield, route_params
+                          in schema.get_route(fieldname))
+            if self.revision != schema.revision:
+                # Guessing modified the schema, so other routes may be stale.
+                self.routes = {}
+                self.revision = schema.revision
+            self.routes[fieldname] = route
+        return route
+
+    def process(self, doc, client=None):
+        """Process an incoming document into a XapianDocument.
+
+        """
+        xdoc = xapian.Document()
+
+        stored = {}
+        state = {}
+
+        started = set()
+        for fieldname, value in utils.iter_doc_fields(doc):
+            for idx, route_params in self.get_route(fieldname, value):
+                if idx not in started:
+                    idx.new_doc(xdoc)
+                    started.add(idx)
+                idx(stored, value, route_params, state)
+
+        xdoc.set_data(utils.encode_data(stored, self.schema.data_codec))
+        return XapianDocument(xdoc, client)
+
 Schema.register_type("TEXT",
                      """Free text - words, to be parsed.""",
                      XapianTextIndexer,
@@ -151,13 +301,19 @@ Schema.register_type("FLOAT",
 def SearchClient(path=None, readonly=False, **kwargs):
     """Factory for XapianBackends.
 
+    `path` may be a list of paths for a readonly client, in which case the
+    databases at all the paths are searched together.
+
     """
     if path is None:
         raise multisearch.errors.BackendError("Missing path argument")
+    if not readonly and not isinstance(path, basestring):
+        raise multisearch.errors.BackendError(
+            "Only readonly clients can be opened on multiple databases")
     if readonly:
-        return ReadonlySearchClient(path)
+        return ReadonlySearchClient(path, **kwargs)
     else:
-        return WritableSearchClient(path)
+        return WritableSearchClient(path, **kwargs)
 
 class XapianDocument(multisearch.Document):
     def __init__(self, raw, client):
@@ -169,38 +325,83 @@ class XapianDocument(multisearch.Document):
         self.raw = raw
         self.client = client
 
+        # The stored data, as a LazyJsonObject, once it's been read.
+        self._data = None
+
     def get_docid(self):
         """Get the document's id.
 
+        The ID is read from the value slot reserved for it, if the schema has
+        one; otherwise, it is found in the document's termlist.
+
         """
-        tl = self.raw.termlist()
-        try:
-            term = tl.skip_to(self.client.idprefix).term
-            if len(term) == 0 or term[0] != self.client.idprefix:
-                return None
-        except StopIteration:
-            return None
-        return term[1:]
+        return self.client._get_docid(self.raw)
 
     def set_docid(self, newid):
         oldid = self.get_docid()
         if oldid is not None:
             self.raw.remove_term(self.client.idprefix + str(oldid))
 
+        slot = self.client.schema.docid_slot
         if newid is not None:
             self.raw.add_term(self.client.idprefix + str(newid), 0)
+            if slot is not None:
+                self.raw.add_value(slot, str(newid))
+        elif slot is not None:
+            self.raw.remove_value(slot)
+
+    def _stored(self):
+        """Get the stored data, wrapped in a LazyJsonObject.
+
+        The data is read from the Xapian document the first time it's needed,
+        but not parsed until its contents are needed.
+
+        """
+        if self._data is None:
+            self._data = utils.LazyJsonObject(
+                json=utils.data_json(self.raw.get_data()))
+        return self._data
 
     def get_data(self):
         """Get the data stored in the document.
 
+        The data is parsed the first time it's requested, and the parsed data
+        is returned for subsequent requests, so it must not be modified (see
+        multisearch.Document.data).
+
+        """
+        return self._stored().data
+
+    def get_data_json(self):
+        """Get the data stored in the document, as a JSON string.
+
+        The data isn't parsed, unless it has already been parsed for some
+        other reason.
+
+        """
+        return self._stored().json
+
+    def get_raw_data(self):
+        """Get the data stored in the document, as encoded in the database.
+
+        The encoding depends on the codec in use when the document was written
+        (see multisearch.utils.datacodec).
+
         """
-        return json.loads(self.raw.get_data())
+        return self.raw.get_data()
 
     def set_data(self, data):
         """Set the data stored in the document.
 
+        The data is encoded with the codec set in the client's schema.
+
         """
-        self.raw.set_data(json.dumps(data, separators=(',', ':')))
+        if self.client is None:
+            codec = 'json'
+        else:
+            codec = self.client.schema.data_codec
+        self.raw.set_data(utils.encode_data(data, codec))
+        self._data = None
 
 class XapianResultDocument(XapianDocument):
     def __init__(self, raw, client, rank):
@@ -222,32 +423,166 @@ class DocumentIter(object):
         posting = self.iter.next()
         return self.factory(posting)
 
+def _encode_cursor(slot, ascending, value, ties, rank):
+    """Encode the position reached in a set of results as a cursor.
+
+    `slot` is the value slot the results are sorted by (None if sorted by
+    relevance), `value` is the last sort value returned (None if no results
+    have been returned), `ties` is the number of results returned with that
+    sort value, and `rank` is the rank of the next result.
+
+    """
+    if value is not None:
+        value = value.encode('hex')
+    state = json.dumps([slot, ascending, value, ties, rank],
+                       separators=(',', ':'))
+    return base64.urlsafe_b64encode(state)
+
+def _decode_cursor(cursor):
+    """Decode a cursor made by _encode_cursor().
+
+    Returns a tuple of (slot, ascending, value, ties, rank).
+
+    """
+    try:
+        slot, ascending, value, ties, rank = \
+            json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if value is not None:
+            value = str(value).decode('hex')
+    except (TypeError, ValueError):
+        raise multisearch.errors.SearchClientError("Invalid cursor %r" %
+                                                   (cursor, ))
+    return slot, ascending, value, ties, rank
+
 class Results(object):
-    def __init__(self, client, mset, start_rank):
+    def __init__(self, client, mset, start_rank, params=None,
+                 position=(None, True, None, 0)):
+        """Create a set of results.
+
+        `position` is a tuple of (slot, ascending, value, ties), describing
+        the sort order of the results, and the position in that order which
+        they start after, as for _encode_cursor().
+
+        """
         self.client = client
         self.mset = mset
         self.start_rank = start_rank
         self.end_rank = start_rank + len(mset)
+        self._rawdocs = None
+        self._position = position
+
+        # True if the search was stopped by its time limit, in which case the
+        # results are the best found in the time available.
+        self.timed_out = False
+
+        if params is None:
+            params = {}
+        self.result_mode = params.get('result_mode')
+        if self.result_mode == 'ids':
+            self._row = self._id_row
+        elif self.result_mode == 'fields':
+            self.fieldnames = params['fields']
+            self._row = self._fields_row
+        else:
+            self._row = self._doc_row
+
+    def _doc_row(self, rawdoc, rank):
+        return XapianResultDocument(rawdoc, self.client, rank)
+
+    def _id_row(self, rawdoc, rank):
+        return self.client._get_docid(rawdoc)
+
+    def _fields_row(self, rawdoc, rank):
+        return (self.client._get_docid(rawdoc),
+                self.client._get_fields(rawdoc, self.fieldnames))
+
+    def prefetch(self):
+        """Load all the documents in the results.
+
+        If Xapian supports it, all the documents are requested together with
+        MSet.fetch(), and then taken from the MSet, so that the backend can
+        read them in whatever order is cheapest (and, for remote databases,
+        in a single round trip).  Otherwise, the documents are read in order
+        of their position in the database, rather than in rank order, to
+        minimise the cost of reading them from disk.  This is done
+        automatically when the results are iterated through.
+
+        """
+        if self._rawdocs is not None:
+            return
+        mset = self.mset
+        load_data = self.result_mode != 'ids'
+        if hasattr(mset, 'fetch'):
+            mset.fetch()
+            rawdocs = [item.document for item in mset]
+        else:
+            db = self.client.db
+            rawdocs = [None] * len(mset)
+            for did, index in sorted((item.docid, index)
+                                     for index, item in enumerate(mset)):
+                rawdocs[index] = db.get_document(did)
+        if load_data:
+            for rawdoc in rawdocs:
+                rawdoc.get_data()
+        self._rawdocs = rawdocs
 
     def __iter__(self):
-        client = self.client
-        db = client.db
-        def factory(posting):
-            rawdoc = posting.document
-            doc = XapianResultDocument(rawdoc, client, posting.rank)
-            return doc
+        self.prefetch()
+        row = self._row
+        start_rank = self.start_rank
+        return (row(rawdoc, start_rank + index)
+                for index, rawdoc in enumerate(self._rawdocs))
 
-        return DocumentIter(iter(self.mset), factory)
+    def documents(self):
+        """Get a list of all the results.
+
+        The items in the list are the same as those produced by iterating
+        through the results.
+
+        """
+        return list(self)
 
     def at_rank(self, rank):
         if self.start_rank > rank or self.end_rank <= rank:
             raise IndexError("result requested at rank %d, which is outside the calculated range of %d-%d" % (rank, self.start_rank, self.end_rank - 1))
-        rawdoc = self.mset[rank - self.start_rank].document
-        return XapianResultDocument(rawdoc, self.client, rank)
+        if self._rawdocs is not None:
+            rawdoc = self._rawdocs[rank - self.start_rank]
+        else:
+            rawdoc = self.mset[rank - self.start_rank].document
+        return self._row(rawdoc, rank)
 
     def __len__(self):
         return len(self.mset)
 
+    @property
+    def cursor(self):
+        """An opaque cursor marking the end of these results.
+
+        Passing this to Search.search_after() returns the results which
+        follow these.  For results sorted by a field, the next page is found
+        by restricting the search to documents whose values in that field
+        are at or after the last value in these results, so the cost of
+        getting a page doesn't grow with the number of pages already
+        returned.  For results sorted by relevance, the cursor simply
+        records the rank to continue from.
+
+        """
+        slot, ascending, value, ties = self._position
+        if slot is not None and len(self.mset) != 0:
+            self.prefetch()
+            values = [rawdoc.get_value(slot) for rawdoc in self._rawdocs]
+            last = values[-1]
+            count = 0
+            for item in reversed(values):
+                if item != last:
+                    break
+                count += 1
+            if count == len(values) and last == value:
+                # All these results are tied with those before them.
+                count += ties
+            value, ties = last, count
+        return _encode_cursor(slot, ascending, value, ties, self.end_rank)
+
     @property
     def matches_lower_bound(self):
         return self.mset.get_matches_lower_bound()
@@ -260,16 +595,159 @@ class Results(object):
     def matches_upper_bound(self):
         return self.mset.get_matches_upper_bound()
 
+def _is_single_term(xq):
+    """Return True if a Xapian query is a single term.
+
+    With versions of Xapian which can't report the type of a query, this
+    also returns True for some other queries containing one term, which is
+    harmless when deciding whether it's worth caching a filter.
+
+    """
+    if hasattr(xq, 'get_type'):
+        return xq.get_type() == xapian.Query.LEAF_TERM
+    return xq.get_length() == 1 and len(list(xq)) == 1
+
 class BaseSearchClient(multisearch.client.BaseSearchClient):
     """Base SearchClient class for Xapian.
 
+    If `result_cache_size` is non-zero, the results of up to that many
+    searches are kept in a cache, and reused if the same search is repeated.
+    If `result_cache_bytes` is also set, the total approximate size of the
+    cached results is also limited.  The cache is emptied whenever the
+    database might have changed: that is, when the database is modified
+    through this client, or reopened.  Statistics about its use are
+    available from `client.result_cache.stats()`.
+
+    If `filter_cache_size` is non-zero, the sets of documents matching up to
+    that many filters (see Search.filter() and Query.filter()) are kept, and
+    used in place of the filter queries when they are used again.  A set is
+    only built once a filter has been used twice.  If `filter_cache_bytes` is
+    also set, the total size of the sets is also limited.  The cache is
+    emptied at the same times as the result cache, and statistics are
+    available from `client.filter_cache.stats()`.  Filters which are a single
+    term are never cached, since Xapian can match them directly more
+    cheaply.  The filter cache requires a version of Xapian which supports
+    posting sources, and can't be used when searching multiple databases.
+
+    `default_timeout` is the time limit, in seconds, for searches which don't
+    have their own timeout or deadline (see Search.timeout()).  If None,
+    such searches have no time limit.  Time limits are enforced by a posting
+    source which filters the query, and stops the match when the time is
+    up; this costs a call into Python for each document the match
+    considers, so should only be used where needed.  Time limits require a
+    version of Xapian which supports posting sources, and can't be used
+    when searching multiple databases.
+
     """
     idprefix = 'Q'
-    def __init__(self):
-        serialised_schema = self.db.get_metadata("__ms:schema")
-        self._schema = Schema.unserialise(serialised_schema)
+
+    # Approximate size, in bytes, of each item in a cached result set.
+    RESULT_CACHE_ITEM_BYTES = 100
+
+    # Approximate size, in bytes, of a cached count.
+    RESULT_CACHE_COUNT_BYTES = 100
+
+    # Number of documents read at a time when building the set of documents
+    # matching a filter, for the filter cache.
+    FILTER_BATCH_SIZE = 10000
+
+    # Number of differently configured query parsers to keep.
+    PARSER_CACHE_SIZE = 64
+
+    # The smallest time limit, in seconds, to apply to a search: searches
+    # which are already past their deadline are still performed with this
+    # limit, to get whatever results can be found immediately.
+    MIN_TIME_LIMIT = 0.001
+
+    # Search parameters which don't affect the results of a search which
+    # isn't stopped by its time limit.
+    _UNCACHED_PARAMS = ('filters', 'timeout', 'deadline')
+
+    def __init__(self, result_cache_size=0, result_cache_bytes=None,
+                 filter_cache_size=0, filter_cache_bytes=None,
+                 default_timeout=None):
+        self._schema = self._load_schema()
+        self.default_timeout = default_timeout
+        if default_timeout is not None:
+            self._check_time_limits()
+
+        self._parsers = utils.LRUCache(self.PARSER_CACHE_SIZE)
+        self._query_generators = {}
+        self._cached_schema = None
+        self._cached_schema_revision = None
+
+        # Counter which is incremented whenever the contents of the database
+        # seen by this client, or its schema, may have changed.
+        self.revision = 0
+
+        # The schema, and its revision, when the revision was last checked.
+        self._revision_schema = None
+        self._revision_schema_revision = None
+
+        if result_cache_size:
+            self.result_cache = utils.LRUCache(result_cache_size,
+                                               result_cache_bytes)
+        else:
+            self.result_cache = None
+
+        if filter_cache_size:
+            if DocidSetPostingSource is None:
+                raise multisearch.errors.FeatureNotAvailableError(
+                    "The filter cache requires a version of Xapian which "
+                    "supports posting sources")
+            if len(getattr(self, 'shards', ())) > 1:
+                raise multisearch.errors.FeatureNotAvailableError(
+                    "The filter cache can't be used when searching multiple "
+                    "databases")
+            self.filter_cache = FilterCache(filter_cache_size,
+                                            filter_cache_bytes)
+        else:
+            self.filter_cache = None
+
+        # Posting sources used by the query currently being compiled, which
+        # must be kept alive until the search has been performed.
+        self._sources = []
         super(BaseSearchClient, self).__init__()
 
+    def reopen(self):
+        """Reopen the database, so that the latest changes are visible.
+
+        """
+        self.db.reopen()
+        self._revised()
+
+    def _revised(self):
+        """Record that the database contents may have changed.
+
+        """
+        self.revision += 1
+        if self.result_cache is not None:
+            self.result_cache.clear()
+        if self.filter_cache is not None:
+            self.filter_cache.clear()
+
+    def _check_schema_revision(self):
+        """Record a change if the schema has been modified or replaced.
+
+        Cached results may depend on the schema (for example, on the slots
+        allocated to fields), so a change to the schema is treated like a
+        change to the database contents, even if no documents have changed.
+
+        """
+        schema = self.schema
+        if self._revision_schema is not schema or \
+           self._revision_schema_revision != schema.revision:
+            if self._revision_schema is not None:
+                self._revised()
+            self._revision_schema = schema
+            self._revision_schema_revision = schema.revision
+
+    def _load_schema(self):
+        """Load the schema from the database.
+
+        """
+        return Schema.unserialise(self.db.get_metadata("__ms:schema"))
+
     @property
     def schema(self):
         """Get the schema in use by this client.
@@ -281,11 +759,12 @@ class BaseSearchClient(multisearch.client.BaseSearchClient):
         """Close any open resources.
 
         """
-        if not isinstance(self.db, ClosedObject):
-            self.commit()
-            if hasattr(self.db, 'close'):
-                self.db.close()
+        if not isinstance(self.db, ClosedObject) and \
+           hasattr(self.db, 'close'):
+            self.db.close()
         self.db = ClosedObject()
+        self._parsers.clear()
+        self._query_generators.clear()
 
     @property
     def document_count(self):
@@ -304,6 +783,32 @@ class BaseSearchClient(multisearch.client.BaseSearchClient):
 
         return DocumentIter(self.db.postlist(''), factory)
 
+    def _get_docid(self, rawdoc):
+        """Get the ID of a Xapian document.
+
+        """
+        slot = self.schema.docid_slot
+        if slot is not None:
+            docid = rawdoc.get_value(slot)
+            if docid:
+                return docid
+        tl = rawdoc.termlist()
+        try:
+            term = tl.skip_to(self.idprefix).term
+            if len(term) == 0 or term[0] != self.idprefix:
+                return None
+        except StopIteration:
+            return None
+        return term[1:]
+
+    def _get_fields(self, rawdoc, fieldnames):
+        """Get the stored values of some fields of a Xapian document.
+
+        Returns a dictionary keyed by fieldname.
+
+        """
+        return utils.decode_fields(rawdoc.get_data(), fieldnames)
+
     def get_docid_term(self, docid):
         """Get the term used to reference a given document ID.
 
@@ -326,7 +831,7 @@ class BaseSearchClient(multisearch.client.BaseSearchClient):
                     raise KeyError("Unique ID %r not found" % docid)
                 return XapianDocument(self.db.get_document(plitem.docid), self)
             except xapian.DatabaseModifiedError, e:
-                self.db.reopen()
+                self.reopen()
 
     def document_exists(self, docid):
         """Return True if a document with the given id exists, False if not.
@@ -334,35 +839,114 @@ class BaseSearchClient(multisearch.client.BaseSearchClient):
         """
         return self.db.term_exists(self.get_docid_term(docid))
 
-    def query(self, value, allow=None, deny=None,
-              default_op=multisearch.queries.Query.AND,
-              allow_wildcards=False):
-        qp = xapian.QueryParser()
-        qp.set_database(self.db)
+    def get_documents(self, docids):
+        """Get several documents, given a sequence of document IDs.
 
-        def totuple(val):
-            if val is None:
-                return ()
-            if isinstance(val, basestring):
-                return (val, )
-            return tuple(val)
+        Returns a list of the documents, in the same order as `docids`, with
+        None in place of any documents which do not exist.
 
-        allow = totuple(allow)
-        deny = totuple(deny)
+        The ID terms are looked up in sorted order, and the documents are
+        then read in order of their position in the database, to minimise the
+        cost of reading them from disk.  If the database is modified while
+        the documents are being read, it is reopened and the whole batch is
+        read again (once).
 
-        if allow and deny:
-            raise multisearch.errors.SearchClientError(
-                "At most one of allow and deny may be specified")
+        """
+        docids = list(docids)
+        terms = sorted(set(self.get_docid_term(docid) for docid in docids))
+        try:
+            found = self._read_documents(terms)
+        except xapian.DatabaseModifiedError:
+            self.reopen()
+            found = self._read_documents(terms)
+        return [found.get(self.get_docid_term(docid)) for docid in docids]
+
+    def _read_documents(self, terms):
+        """Read the documents with the given ID terms.
+
+        Returns a dictionary mapping from ID term to document, with no entries
+        for terms which don't match any document.
+
+        """
+        db = self.db
+        dids = []
+        for term in terms:
+            for plitem in db.postlist(term):
+                dids.append((plitem.docid, term))
+                break
+        dids.sort()
+        found = {}
+        for did, term in dids:
+            rawdoc = db.get_document(did)
+            rawdoc.get_data()
+            found[term] = XapianDocument(rawdoc, self)
+        return found
+
+    def document_exists_many(self, docids):
+        """Check whether several documents exist.
+
+        Returns a list of booleans, in the same order as `docids`.  The ID
+        terms are looked up in sorted order.
+
+        """
+        docids = list(docids)
+        terms = sorted(set(self.get_docid_term(docid) for docid in docids))
+        try:
+            existing = self._existing_terms(terms)
+        except xapian.DatabaseModifiedError:
+            self.reopen()
+            existing = self._existing_terms(terms)
+        return [self.get_docid_term(docid) in existing for docid in docids]
+
+    def _existing_terms(self, terms):
+        """Get the set of the given terms which exist in the database.
+
+        """
+        term_exists = self.db.term_exists
+        return set(term for term in terms if term_exists(term))
+
+    def _schema_caches(self):
+        """Get the caches of objects built from the current schema.
+
+        Returns a tuple (parsers, query_generators): the caches are emptied
+        whenever the schema is changed or replaced.
+
+        """
+        schema = self.schema
+        if self._cached_schema is not schema or \
+           self._cached_schema_revision != schema.revision:
+            self._parsers.clear()
+            self._query_generators.clear()
+            self._cached_schema = schema
+            self._cached_schema_revision = schema.revision
+        return self._parsers, self._query_generators
+
+    def _query_parser(self, allow, deny, default_op):
+        """Get a query parser configured to search the given fields.
+
+        Returns a tuple (parser, allow), where `allow` is the list of fields
+        which the parser will search.  Parsers are cached for each
+        configuration, and reused until the schema changes.
+
+        """
+        parsers = self._schema_caches()[0]
+        key = (allow, deny, default_op)
+        cached = parsers.get(key)
+        if cached is not None:
+            return cached
 
         if not allow:
             allow = tuple(fieldname
                           for fieldname in self.schema.fields_of_type('TEXT')
                           if fieldname != '')
-        if not deny:
+        if deny:
             allow = tuple(fieldname
                           for fieldname in allow
                           if fieldname not in deny)
 
+        qp = xapian.QueryParser()
+        qp.set_database(self.db)
+        qp.set_default_op(_opmap[default_op])
         for fieldname in allow:
             type, params = self.schema.get(fieldname)
             if type == 'TEXT':
@@ -381,6 +965,28 @@ class BaseSearchClient(multisearch.client.BaseSearchClient):
         except KeyError:
             pass
 
+        cached = (qp, allow)
+        parsers.put(key, cached)
+        return cached
+
+    def query(self, value, allow=None, deny=None,
+              default_op=multisearch.queries.Query.AND,
+              allow_wildcards=False):
+        def totuple(val):
+            if val is None:
+                return ()
+            if isinstance(val, basestring):
+                return (val, )
+            return tuple(val)
+
+        allow = totuple(allow)
+        deny = totuple(deny)
+
+        if allow and deny:
+            raise multisearch.errors.SearchClientError(
+                "At most one of allow and deny may be specified")
+
+        qp, allow = self._query_parser(allow, deny, default_op)
 
         baseflags = (xapian.QueryParser.FLAG_LOVEHATE |
                      xapian.QueryParser.FLAG_PHRASE |
@@ -399,7 +1005,11 @@ class BaseSearchClient(multisearch.client.BaseSearchClient):
 
     def query_field(self, fieldname, *args, **kwargs):
         # FIXME - document
-        qg = self.schema.query_generator(fieldname)
+        query_generators = self._schema_caches()[1]
+        qg = query_generators.get(fieldname, None)
+        if qg is None:
+            qg = self.schema.query_generator(fieldname)
+            query_generators[fieldname] = qg
         query = qg(self, *args, **kwargs)
         query.connect(self)
         query._set_params('query_field',
@@ -412,7 +1022,13 @@ class BaseSearchClient(multisearch.client.BaseSearchClient):
 
         """
         if isinstance(query, multisearch.queries.QueryCombination):
-            subqs = [self.compile(subq) for subq in query.subqs]
+            if query.op == multisearch.queries.Query.FILTER and \
+               self.filter_cache is not None:
+                subqs = [self.compile(query.subqs[0])]
+                subqs.extend(self._compile_filter(subq)
+                             for subq in query.subqs[1:])
+            else:
+                subqs = [self.compile(subq) for subq in query.subqs]
             try:
                 op = _opmap[query.op]
             except KeyError:
@@ -437,6 +1053,194 @@ class BaseSearchClient(multisearch.client.BaseSearchClient):
             raise multisearch.errors.UnknownQueryTypeError(
                 "Query %s of unknown type" % query)
 
+    def _compile_filter(self, query):
+        """Make a xapian Query for a filter, using the filter cache.
+
+        """
+        xq = self.compile(query)
+        if _is_single_term(xq):
+            # Xapian reads a single term's postlist directly, which is
+            # cheaper than reading the documents from a set in Python.
+            return xq
+        key = (self.revision, query.canonical())
+        docids = self.filter_cache.get(key, lambda: self._filter_docids(xq))
+        if docids is None:
+            return xq
+        source = DocidSetPostingSource(docids)
+        self._sources.append(source)
+        return xapian.Query(source)
+
+    def _filter_docids(self, xq):
+        """Get the set of documents matching a compiled filter.
+
+        The documents are read in batches of FILTER_BATCH_SIZE, in order of
+        document ID, so the memory used while building the set is bounded
+        by the size of the batches and of the set itself.
+
+        """
+        enq = xapian.Enquire(self.db)
+        enq.set_weighting_scheme(xapian.BoolWeight())
+        enq.set_docid_order(xapian.Enquire.ASCENDING)
+        docids = array.array('I')
+        next_docid = 1
+        while True:
+            source = DocidRangePostingSource(next_docid)
+            enq.set_query(xapian.Query(xapian.Query.OP_FILTER, xq,
+                                       xapian.Query(source)))
+            mset = enq.get_mset(0, self.FILTER_BATCH_SIZE)
+            docids.extend(item.docid for item in mset)
+            if len(mset) < self.FILTER_BATCH_SIZE:
+                break
+            next_docid = docids[-1] + 1
+        return DocidSet(docids, self.db.get_lastdocid())
+
+    def _prepare_query(self, query, params):
+        """Combine a query with the filters in a set of search parameters.
+
+        Returns the optimised query.
+
+        """
+        self._check_schema_revision()
+        filters = params.get('filters')
+        if filters:
+            query = multisearch.queries.QueryFilter((query, ) + filters)
+        return query.optimise()
+
+    def count(self, query, params, exact=False):
+        """Count the documents matching a search.
+
+        Returns a multisearch.queries.MatchCount.  See Search.count() for the
+        meaning of `exact`.  No weights are calculated, and no documents are
+        fetched.  Counts are kept in the result cache, if there is one.
+
+        """
+        query = self._prepare_query(query, params)
+        if exact is True:
+            check_at_least = self.db.get_doccount()
+        elif not exact:
+            check_at_least = 0
+        else:
+            check_at_least = int(exact)
+
+        cache = self.result_cache
+        if cache is not None:
+            cache_key = (self.revision, query.canonical(), 'count',
+                         check_at_least)
+            count = cache.get(cache_key)
+            if count is not None:
+                return count
+
+        enq = xapian.Enquire(self.db)
+        enq.set_weighting_scheme(xapian.BoolWeight())
+        try:
+            enq.set_query(self.compile(query))
+            mset = enq.get_mset(0, 0, check_at_least)
+        finally:
+            del self._sources[:]
+        count = multisearch.queries.MatchCount(
+            mset.get_matches_lower_bound(),
+            mset.get_matches_estimated(),
+            mset.get_matches_upper_bound())
+        if cache is not None:
+            cache.put(cache_key, count, len(repr(cache_key[1])) +
+                      self.RESULT_CACHE_COUNT_BYTES)
+        return count
+
+    def scan(self, query, params, batch_size=1000):
+        """Iterate through all the results of a search, in batches.
+
+        Yields lists of up to `batch_size` results, without ranking them.
+        Results are returned in order of internal document ID.  Each batch is
+        found by restricting the query to documents after the last one in
+        the previous batch, so the memory used doesn't grow as the scan
+        proceeds, and if the database is modified during the scan it is
+        reopened and the scan continues from where it got to.
+
+        When searching multiple databases, or if Xapian doesn't support
+        posting sources, the batches are found by offset instead: this uses
+        memory proportional to the number of results returned so far, and
+        modifications to the database may cause results to be skipped or
+        repeated.
+
+        """
+        query = self._prepare_query(query, params)
+
+        # The compiled query, and the posting sources from the filter cache
+        # which it uses, which must be kept alive while it's in use.
+        compiled = None
+
+        enq = xapian.Enquire(self.db)
+        enq.set_weighting_scheme(xapian.BoolWeight())
+        enq.set_docid_order(xapian.Enquire.ASCENDING)
+        by_docid = DocidRangePostingSource is not None and \
+            len(getattr(self, 'shards', ())) <= 1
+
+        next_docid = 1
+        offset = 0
+        while True:
+            if compiled is None:
+                compiled = (self.compile(query), list(self._sources))
+                del self._sources[:]
+            xq = compiled[0]
+            try:
+                if by_docid:
+                    source = DocidRangePostingSource(next_docid)
+                    enq.set_query(xapian.Query(xapian.Query.OP_FILTER, xq,
+                                               xapian.Query(source)))
+                    mset = enq.get_mset(0, batch_size)
+                else:
+                    enq.set_query(xq)
+                    mset = enq.get_mset(offset, batch_size)
+                batch = Results(self, mset, offset, params).documents()
+            except xapian.DatabaseModifiedError:
+                if not by_docid:
+                    raise
+                self.reopen()
+                # Reopening empties the filter cache, since the sets of
+                # documents matching the filters may have changed, so the
+                # query must be compiled again.
+                compiled = None
+                continue
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                return
+            offset += len(batch)
+            next_docid = max(item.docid for item in mset) + 1
+
+    def _check_time_limits(self):
+        """Raise FeatureNotAvailableError if time limits can't be applied.
+
+        """
+        if DeadlinePostingSource is None:
+            raise multisearch.errors.FeatureNotAvailableError(
+                "Time limits require a version of Xapian which supports "
+                "posting sources")
+        if len(getattr(self, 'shards', ())) > 1:
+            raise multisearch.errors.FeatureNotAvailableError(
+                "Time limits can't be used when searching multiple databases")
+
+    def _time_limit(self, params):
+        """Get the time limit for a search, in seconds.
+
+        Returns None if the search has no time limit.  Raises
+        FeatureNotAvailableError if it has one, but time limits can't be
+        applied.
+
+        """
+        timeout = params.get('timeout')
+        deadline = params.get('deadline')
+        if timeout is None and deadline is None:
+            timeout = self.default_timeout
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        if timeout is None:
+            return None
+        self._check_time_limits()
+        return max(timeout, self.MIN_TIME_LIMIT)
+
     def search(self, query, params):
         """Perform a search.
 
@@ -444,10 +1248,29 @@ class BaseSearchClient(multisearch.client.BaseSearchClient):
         params should be a dict of parameters.
 
         """
+        query = self._prepare_query(query, params)
+        time_limit = self._time_limit(params)
+
+        cache = self.result_cache
+        cache_key = None
+        if cache is not None and not params.get('search_args'):
+            # The canonical form of the query (which includes the filters) is
+            # used, rather than the compiled query, so that cached results can
+            # be returned without compiling the query.
+            cache_key = (self.revision, query.canonical(),
+                         repr(sorted(item for item in params.iteritems()
+                                     if item[0] not in self._UNCACHED_PARAMS)))
+            cached = cache.get(cache_key)
+            if cached is not None:
+                # A new Results is made for each search, since it holds the
+                # state of iterating through the results.
+                return Results(self, *cached)
+
         xq = self.compile(query)
         enq = xapian.Enquire(self.db)
-        enq.set_query(xq)
 
+        slot = None
+        ascending = True
         order_by = params.get('order_by')
         if order_by:
             if not isinstance(order_by, basestring):
@@ -467,35 +1290,156 @@ class BaseSearchClient(multisearch.client.BaseSearchClient):
                     raise multisearch.errors.FeatureNotAvailableError("Cannot sort by this field type - no associated slot")
                 enq.set_sort_by_value(slot, not ascending)
 
+        start_rank = params['start_rank']
+        end_rank = params['end_rank']
+        offset = start_rank
+        value = None
+        ties = 0
+        cursor = params.get('search_after')
+        if cursor is not None:
+            (cursor_slot, cursor_ascending, value, ties,
+             start_rank) = _decode_cursor(cursor)
+            if cursor_slot != slot or \
+               (slot is not None and cursor_ascending != ascending):
+                raise multisearch.errors.SearchClientError(
+                    "Cursor was made for results in a different order")
+            if slot is None:
+                offset = start_rank
+            else:
+                # Results are ordered by value, and then by docid, so the
+                # results after the cursor are those with a value beyond the
+                # last value returned, after skipping the results with that
+                # value which have already been returned.
+                #
+                # Documents with no value in the slot sort as if the value
+                # were empty, but aren't matched by value range queries, so
+                # an empty value can't be used as a range limit.
+                offset = ties
+                if value is not None and ascending:
+                    if value != '':
+                        xq = xapian.Query(xapian.Query.OP_FILTER, xq,
+                            xapian.Query(xapian.Query.OP_VALUE_GE, slot,
+                                         value))
+                elif value is not None:
+                    # Exclude the values greater than the last value returned
+                    # (the smallest of which is value + '\0'), which keeps
+                    # the documents with no value.
+                    xq = xapian.Query(xapian.Query.OP_AND_NOT, xq,
+                        xapian.Query(xapian.Query.OP_VALUE_GE, slot,
+                                     value + '\0'))
+
+        deadline = None
+        if time_limit is not None:
+            deadline = DeadlinePostingSource(time_limit)
+            xq = xapian.Query(xapian.Query.OP_FILTER, xq,
+                              xapian.Query(deadline))
+        enq.set_query(xq)
+
         check_at_least = params.get('check_at_least', 0)
         if check_at_least == -1:
             check_at_least = self.db.get_doccount()
         extra_args = list(params.get('search_args', []))
 
-        start_rank = params['start_rank']
-        end_rank = params['end_rank']
-        mset = enq.get_mset(start_rank, end_rank - start_rank,
-                            check_at_least, *extra_args)
-        return Results(self, mset, start_rank)
+        try:
+            mset = enq.get_mset(offset, end_rank - params['start_rank'],
+                                check_at_least, *extra_args)
+        finally:
+            del self._sources[:]
+        position = (slot, ascending, value, ties)
+        results = Results(self, mset, start_rank, params, position)
+        if deadline is not None and deadline.expired:
+            results.timed_out = True
+        elif cache_key is not None:
+            cache.put(cache_key, (mset, start_rank, dict(params), position),
+                      len(repr(cache_key[1])) + len(cache_key[2]) +
+                      self.RESULT_CACHE_ITEM_BYTES * len(mset))
+        return results
 
 class ReadonlySearchClient(BaseSearchClient):
     """A readonly Xapian SearchClient.
 
+    `path` may be a single path, or a sequence of paths of databases which
+    are to be searched together as if they were a single database.  In the
+    latter case, the schemas stored in the databases must be compatible.
+
     """
-    def __init__(self, path):
-        self.db = xapian.Database(path)
+    def __init__(self, path, **kwargs):
+        if isinstance(path, basestring):
+            self.shards = [xapian.Database(path)]
+            self.db = self.shards[0]
+        else:
+            path = list(path)
+            self.shards = [xapian.Database(p) for p in path]
+            self.db = xapian.Database()
+            for shard in self.shards:
+                self.db.add_database(shard)
         self.path = path
-        super(ReadonlySearchClient, self).__init__()
+        super(ReadonlySearchClient, self).__init__(**kwargs)
         self.schema.modifiable = False
 
+    def _load_schema(self):
+        """Load the schema, merging the schemas from each database.
+
+        """
+        if len(self.shards) == 1:
+            return super(ReadonlySearchClient, self)._load_schema()
+        return Schema.merge(Schema.unserialise(
+                                shard.get_metadata("__ms:schema"))
+                            for shard in self.shards)
+
 class WritableSearchClient(BaseSearchClient):
     """A writable Xapian SearchClient.
 
+    If `append_only` is True, all updates are performed as if `assume_new`
+    had been passed to update(): documents are appended to the database
+    without checking whether their IDs are already in use.  This is intended
+    for fast loading of documents into a fresh database.
+
+    `docid_allocator` is used to allocate IDs for documents which are added
+    without one.  It should be an instance of
+    multisearch.utils.DocidAllocator; if None, random IDs are used.  IDs from
+    allocators which are unique by construction are used without checking
+    whether they are already in the database.
+
+    `commit_policy` may be an instance of multisearch.utils.CommitPolicy, in
+    which case changes are committed automatically whenever the policy says
+    that a commit is due.  If None, changes are only committed when commit()
+    or flush() is called (or the client is closed).
+
+    `data_codec` may be the name of a codec from multisearch.utils.datacodec,
+    in which case it is recorded in the schema and used to encode the stored
+    data of documents written from now on.  Documents which have already been
+    written remain readable whatever codec is set.
+
+    If `processes` is greater than 1, a pool of that many worker processes is
+    started (before the database is opened), and used by update_many() to
+    process documents in parallel.  The pool is stopped when the client is
+    closed.
+
     """
-    def __init__(self, path):
-        self.db = xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OPEN)
+    def __init__(self, path, append_only=False, docid_allocator=None,
+                 commit_policy=None, data_codec=None, processes=None,
+                 **kwargs):
+        self._pool = None
+        if processes is not None and processes > 1:
+            from multisearch.backends.xapian_backend import pipeline
+            self._pool = pipeline.WorkerPool(processes)
+        try:
+            self.db = xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OPEN)
+        except:
+            if self._pool is not None:
+                self._pool.close()
+            raise
         self.path = path
-        super(WritableSearchClient, self).__init__()
+        self.append_only = append_only
+        if docid_allocator is None:
+            docid_allocator = utils.RandomDocidAllocator()
+        self.docid_allocator = docid_allocator
+        self.commit_policy = commit_policy
+        self._plan = None
+        super(WritableSearchClient, self).__init__(**kwargs)
+        if data_codec is not None:
+            self.schema.set_data_codec(data_codec)
 
     def commit(self):
         """Commit any changes which are currently in progress.
@@ -510,52 +1454,239 @@ class WritableSearchClient(BaseSearchClient):
             # Backwards compatibility: in the 1.0 series, databases don't have
             # a commit method.
             self.db.flush()
+        if self.commit_policy is not None:
+            self.commit_policy.reset()
 
-    def process(self, doc):
-        """Process an incoming document into a Xapian document.
+    def close(self):
+        """Commit any changes, and close any open resources.
 
         """
-        xdoc = xapian.Document()
-        s = self.schema
+        try:
+            if not isinstance(self.db, ClosedObject):
+                self.commit()
+            super(WritableSearchClient, self).close()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
 
-        stored = {}
-        state = {}
+    def _set_schema(self, schema):
+        """Replace the schema in use by this client.
 
-        idxs = {}
-        for fieldname, value in utils.iter_doc_fields(doc):
-            s.guess(fieldname, value)
-            for destfield, route_params in s.get_route(fieldname):
-                idx = idxs.get(destfield, None)
-                if idx is None:
-                    idxs[destfield] = idx = self.schema.indexer(destfield)
-                    idx.new_doc(xdoc)
-                idx(stored, value, route_params, state)
+        The new schema will be written to the database at the next commit if
+        it is marked as modified.
 
-        result = XapianDocument(xdoc, self)
-        result.set_data(stored)
-        return result
+        """
+        self._schema = schema
+
+    def flush(self):
+        """Empty any buffered changes.
+
+        Xapian has no way to write buffered changes without committing them,
+        so this is equivalent to commit().
+
+        """
+        self.commit()
+
+    def _changed(self, nbytes=0):
+        """Record that a document has been changed, committing if the commit
+        policy says that a commit is due.
+
+        """
+        policy = self.commit_policy
+        if policy is not None and policy.record(1, nbytes):
+            self.commit()
+
+    def _doc_size(self, doc):
+        """Get the size of a document, if the commit policy needs it.
+
+        """
+        policy = self.commit_policy
+        if policy is None or not policy.measures_bytes or \
+           isinstance(doc, xapian.Document):
+            return 0
+        return utils.doc_size(doc)
+
+    def process(self, doc):
+        """Process an incoming document into a Xapian document.
+
+        """
+        plan = self._plan
+        if plan is None or plan.schema is not self.schema:
+            self._plan = plan = IndexingPlan(self.schema)
+        return plan.process(doc, self)
 
     def update(self, doc, docid=None, fail_if_exists=False, assume_new=False):
+        assume_new = assume_new or self.append_only
         if docid is None:
-            while True:
-                docid = utils.make_docid()
-                docidterm = self.get_docid_term(docid)
-                if not self.db.term_exists(docidterm):
-                    break
+            docid = self._alloc_docids(1, not assume_new)[0]
         else:
             docid = str(docid)
-            docidterm = self.get_docid_term(docid)
-            if fail_if_exists and not self.db.term_exists(docidterm):
+            if fail_if_exists:
+                self._check_new_docids((docid, ))
+
+        self._write(docid, doc, assume_new)
+        self._changed(self._doc_size(doc))
+        return docid
+
+    def update_many(self, docs, fail_if_exists=False, assume_new=False,
+                    batch_size=1000, max_pending=None):
+        """Add or update a sequence of documents.
+
+        `docs` is an iterable of (docid, doc) pairs, as for
+        multisearch.client.BaseSearchClient.update_many().  The documents are
+        handled in batches of up to `batch_size` documents: the checks for
+        existing document IDs in each batch are performed together, in sorted
+        term order, and then the documents in the batch are processed and
+        written.  If `fail_if_exists` is set and any document in a batch
+        already exists, DocExistsError is raised before any of the documents
+        in that batch are written.
+
+        If the client was opened with a pool of worker processes, the
+        documents are processed in the pool, and this client only writes the
+        processed documents to the database.  At most `max_pending` batches
+        (by default, twice the number of processes) are handed to the workers
+        at a time, so `docs` is only read as fast as the workers can keep up.
+        Batches are always written in the order in which they were supplied,
+        so if a document ID is repeated the last document supplied with that
+        ID is the one which ends up in the database.  See
+        multisearch.backends.xapian_backend.pipeline for details.
+
+        Returns an iterator over the document IDs used, which yields the IDs
+        for each batch once the batch has been written.
+
+        """
+        assume_new = assume_new or self.append_only
+        batches = (self._prepare_batch(batch, assume_new)
+                   for batch in utils.iter_batches(docs, batch_size))
+        if self._pool is not None:
+            processed = self._pool.process_batches(self.schema, batches,
+                                                    max_pending)
+        else:
+            processed = ((tag, [doc if isinstance(doc, xapian.Document)
+                                else self.process(doc).raw
+                                for doc in docs])
+                         for tag, docs in batches)
+
+        for (docids, supplied, sizes), xdocs in processed:
+            if fail_if_exists:
+                self._check_new_docids(supplied)
+            for docid, xdoc, size in zip(docids, xdocs, sizes):
+                self._write(docid, xdoc, assume_new)
+                self._changed(size)
+            for docid in docids:
+                yield docid
+
+    def _prepare_batch(self, batch, assume_new):
+        """Assign IDs to a batch of (docid, doc) pairs.
+
+        Returns ((docids, supplied, sizes), docs), where `supplied` is a list
+        of the IDs which were supplied by the caller rather than allocated, and
+        `sizes` is a list of the sizes of the documents (as needed by the
+        commit policy).
+
+        """
+        newids = iter(self._alloc_docids(sum(1 for docid, doc in batch
+                                             if docid is None),
+                                         not assume_new))
+        docids = [next(newids) if docid is None else str(docid)
+                  for docid, doc in batch]
+        supplied = [newid for (docid, doc), newid in zip(batch, docids)
+                    if docid is not None]
+        docs = [doc for docid, doc in batch]
+        sizes = [self._doc_size(doc) for doc in docs]
+        return (docids, supplied, sizes), docs
+
+    def _alloc_docids(self, count, check=True):
+        """Allocate `count` new, unused, document IDs.
+
+        If `check` is False, or the allocator in use produces unique IDs, the
+        IDs are not checked against those already in the database.
+
+        """
+        alloc = self.docid_allocator
+        if not check or alloc.unique:
+            return [alloc() for _ in xrange(count)]
+        result = []
+        while len(result) < count:
+            candidates = dict((self.get_docid_term(docid), docid)
+                              for docid in (alloc()
+                                            for _ in xrange(count - len(result))))
+            for docidterm in sorted(candidates):
+                if not self.db.term_exists(docidterm):
+                    result.append(candidates[docidterm])
+        return result
+
+    def _check_new_docids(self, docids):
+        """Raise DocExistsError if any of the docids are already in use.
+
+        Also raises DocExistsError if any docid is repeated.
+
+        """
+        seen = set()
+        for docidterm, docid in sorted((self.get_docid_term(docid), docid)
+                                       for docid in docids):
+            if docidterm in seen or self.db.term_exists(docidterm):
                 raise multisearch.errors.DocExistsError(
                     "Document with ID %r already exists" % docid)
+            seen.add(docidterm)
+
+    def _write(self, docid, doc, assume_new=False):
+        """Write a document to the database, replacing any existing document
+        with the same ID.
+
+        If `assume_new` is True, the document is simply appended to the
+        database, which avoids looking up the ID term.
 
+        """
         if isinstance(doc, xapian.Document):
             xdoc = doc
         else:
             xdoc = self.process(doc).raw
+        docidterm = self.get_docid_term(docid)
         xdoc.add_term(docidterm)
-        self.db.replace_document(docidterm, xdoc)
-        return docid
+        if self.schema.docid_slot is not None:
+            xdoc.add_value(self.schema.docid_slot, docid)
+        if assume_new:
+            self.db.add_document(xdoc)
+        else:
+            self.db.replace_document(docidterm, xdoc)
+        self._revised()
+
+    def migrate_docid_slot(self, batch_size=10000):
+        """Store document IDs in a value slot, for a database created before
+        IDs were stored in a slot.
+
+        Every document in the database is rewritten, with changes committed
+        after every `batch_size` documents.  Until this has been done,
+        reading the ID of a document from such a database needs a scan of the
+        document's termlist.
+
+        """
+        schema = self.schema
+        if schema.docid_slot is not None:
+            return
+        # Check before touching any documents, so that a refused migration
+        # doesn't leave the database half migrated.
+        schema.check_modifiable()
+        slot = Schema.DOCID_SLOT
+        count = 0
+        for did in xrange(1, self.db.get_lastdocid() + 1):
+            try:
+                xdoc = self.db.get_document(did)
+            except xapian.DocNotFoundError:
+                continue
+            docid = XapianDocument(xdoc, self).get_docid()
+            if docid is None:
+                continue
+            xdoc.add_value(slot, docid)
+            self.db.replace_document(did, xdoc)
+            count += 1
+            if count % batch_size == 0:
+                self.commit()
+        schema.docid_slot = slot
+        schema.mark_modified()
+        self._revised()
+        self.commit()
 
     def delete(self, docid, fail_if_missing=False):
         docidterm = self.get_docid_term(docid)
@@ -563,6 +1694,8 @@ class WritableSearchClient(BaseSearchClient):
             raise multisearch.errors.DocNotFoundError(
                 "No document with ID %r found when deleting" % docid)
         self.db.delete_document(docidterm)
+        self._revised()
+        self._changed()
 
     def destroy_database(self):
         if hasattr(self.db, 'close'):
@@ -0,0 +1,145 @@
+# Copyright (c) 2010 Richard Boulton
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+r"""Caching of the documents matching frequently used filters.
+
+The set of documents matching a filter is held as a DocidSet: either a sorted
+array of document IDs, or a bitmap, whichever is smaller.  When a cached
+filter is used again, it is matched with a DocidSetPostingSource, which reads
+the document IDs from the set, rather than by running the filter query again.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import array
+import bisect
+from multisearch import utils
+
+class DocidSet(object):
+    """An immutable set of Xapian document IDs.
+
+    """
+    def __init__(self, docids, lastdocid):
+        """Create a set from a sorted list of document IDs.
+
+        `lastdocid` is the highest document ID in use in the database.
+
+        """
+        self.count = len(docids)
+        bitmap_bytes = (lastdocid >> 3) + 1
+        ids = array.array('I', docids)
+        if bitmap_bytes < ids.itemsize * len(ids):
+            self.ids = None
+            self.bits = bytearray(bitmap_bytes)
+            for did in docids:
+                self.bits[did >> 3] |= 1 << (did & 7)
+            self.nbytes = bitmap_bytes
+        else:
+            self.ids = ids
+            self.bits = None
+            self.nbytes = ids.itemsize * len(ids)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, did):
+        if self.bits is None:
+            pos = bisect.bisect_left(self.ids, did)
+            return pos < len(self.ids) and self.ids[pos] == did
+        byte = did >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] &
+                                              (1 << (did & 7)))
+
+    def next_from(self, did):
+        """Get the lowest document ID in the set which is at least `did`.
+
+        Returns None if there is no such document ID.
+
+        """
+        if self.bits is None:
+            pos = bisect.bisect_left(self.ids, did)
+            if pos == len(self.ids):
+                return None
+            return self.ids[pos]
+
+        bits = self.bits
+        byte = did >> 3
+        if byte >= len(bits):
+            return None
+        value = bits[byte] >> (did & 7)
+        if not value:
+            byte += 1
+            while byte < len(bits) and not bits[byte]:
+                byte += 1
+            if byte == len(bits):
+                return None
+            value = bits[byte]
+            did = byte << 3
+        while not value & 1:
+            value >>= 1
+            did += 1
+        return did
+
+class FilterCache(object):
+    """A cache of the sets of documents matching filters.
+
+    A set is only built for a filter once the filter has been used
+    `min_uses` times, so that filters which are used only once don't push
+    frequently used filters out of the cache.  The sets are kept in an
+    LRUCache, which holds at most `max_entries` sets, and, if `max_bytes` is
+    not None, sets whose sizes add up to at most `max_bytes`.
+
+    """
+    def __init__(self, max_entries, max_bytes=None, min_uses=2):
+        self.sets = utils.LRUCache(max_entries, max_bytes)
+        self.uses = utils.LRUCache(max_entries * 4)
+        self.min_uses = min_uses
+
+    def clear(self):
+        """Remove all entries from the cache.
+
+        """
+        self.sets.clear()
+        self.uses.clear()
+
+    def get(self, key, build):
+        """Get the set for a filter.
+
+        If the set isn't cached, but the filter has now been used often
+        enough, `build` is called to build the set, which is then cached.
+        Returns None if there is no set for the filter yet.
+
+        """
+        docids = self.sets.get(key)
+        if docids is not None:
+            return docids
+        uses = self.uses.get(key, 0) + 1
+        if uses < self.min_uses:
+            self.uses.put(key, uses)
+            return None
+        self.uses.discard(key)
+        docids = build()
+        self.sets.put(key, docids, docids.nbytes)
+        return docids
+
+    def stats(self):
+        """Get a dictionary of statistics about the cache.
+
+        """
+        return self.sets.stats()
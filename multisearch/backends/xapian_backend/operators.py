@@ -31,4 +31,5 @@ _opmap = {
     multisearch.queries.Query.XOR: xapian.Query.OP_XOR,
     multisearch.queries.Query.NOT: xapian.Query.OP_AND_NOT,
     multisearch.queries.Query.AND_MAYBE: xapian.Query.OP_AND_MAYBE,
+    multisearch.queries.Query.FILTER: xapian.Query.OP_FILTER,
 }
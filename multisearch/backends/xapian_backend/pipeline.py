@@ -0,0 +1,151 @@
+# Copyright (c) 2010 Richard Boulton
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+r"""Parallel processing of documents for indexing.
+
+A Xapian database can only have a single writer, but processing documents
+(splitting text into words, stemming, and so on) can be spread over several
+processes.  A WorkerPool runs the indexers from a schema in a pool of worker
+processes, and returns the resulting Xapian documents to the parent process to
+be written.
+
+The worker processes are forked when the pool is created, so a pool should be
+created before the database it feeds is opened for writing: otherwise the
+workers would inherit the writer's open files and lock.  The pool is reused
+for every batch until it is closed.
+
+Fields are guessed in the parent process before documents are handed to the
+workers, so that all changes to the schema are made in one place.  Whenever
+the schema changes, the new version is sent to the workers with the next
+batch of documents.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import collections
+import multiprocessing
+import multisearch.errors
+from multisearch import utils
+import xapian
+
+class WorkerPool(object):
+    """A pool of worker processes for processing documents.
+
+    """
+    def __init__(self, processes):
+        if not hasattr(xapian.Document, 'unserialise'):
+            raise multisearch.errors.FeatureNotAvailableError(
+                "Parallel processing requires a version of Xapian which can "
+                "serialise documents")
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes)
+
+    def close(self):
+        """Stop the worker processes, and wait for them to exit.
+
+        Any batches still being processed are abandoned.
+
+        """
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            try:
+                pool.terminate()
+            finally:
+                pool.join()
+
+    def process_batches(self, schema, batches, max_pending=None):
+        """Process batches of documents in the worker processes.
+
+        `batches` is an iterable of (tag, docs) pairs, where `docs` is a
+        sequence of documents to be processed with `schema`, and `tag` is any
+        value, which is passed back unchanged.  Any documents which are
+        already Xapian documents are passed through without being processed.
+
+        Yields (tag, xdocs) pairs, where `xdocs` is a list of the processed
+        Xapian documents, in the same order as the batches were supplied.  At
+        most `max_pending` batches (by default, twice the number of processes)
+        are read from `batches` ahead of the batch most recently returned.
+
+        """
+        if self.pool is None:
+            raise multisearch.errors.SearchClientError(
+                "Worker pool has been closed")
+        if max_pending is None:
+            max_pending = self.processes * 2
+
+        pending = collections.deque()
+        serialised_schema = None
+        revision = None
+        for tag, docs in batches:
+            docs = list(docs)
+            raw = []
+            for doc in docs:
+                if isinstance(doc, xapian.Document):
+                    raw.append(None)
+                    continue
+                fields = list(utils.iter_doc_fields(doc))
+                for fieldname, value in fields:
+                    schema.guess(fieldname, value)
+                raw.append(fields)
+            if serialised_schema is None or revision != schema.revision:
+                serialised_schema = schema.serialise()
+                revision = schema.revision
+
+            result = self.pool.apply_async(_process_docs,
+                                           (serialised_schema, raw))
+            pending.append((tag, docs, result))
+            if len(pending) >= max_pending:
+                yield _collect(*pending.popleft())
+        while pending:
+            yield _collect(*pending.popleft())
+
+def _collect(tag, docs, result):
+    """Wait for a batch to be processed, and unserialise the results.
+
+    """
+    xdocs = []
+    for doc, serialised in zip(docs, result.get()):
+        if serialised is None:
+            xdocs.append(doc)
+        else:
+            xdocs.append(xapian.Document.unserialise(serialised))
+    return tag, xdocs
+
+# The schema currently in use in a worker process, in serialised form, and the
+# indexing plan for it.
+_worker_schema = None
+_worker_plan = None
+
+def _process_docs(serialised_schema, docs):
+    """Process a list of documents in a worker process.
+
+    Returns a list of serialised Xapian documents; None is returned in place of
+    any None items in `docs`.
+
+    """
+    global _worker_schema, _worker_plan
+    if serialised_schema != _worker_schema:
+        from multisearch.backends.xapian_backend.client import Schema, \
+             IndexingPlan
+        schema = Schema.unserialise(serialised_schema)
+        schema.modifiable = False
+        _worker_plan = IndexingPlan(schema)
+        _worker_schema = serialised_schema
+    return [None if doc is None else _worker_plan.process(doc).raw.serialise()
+            for doc in docs]
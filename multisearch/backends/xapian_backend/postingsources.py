@@ -0,0 +1,149 @@
+# Copyright (c) 2010 Richard Boulton
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+r"""Posting sources implemented in Python.
+
+These are only available with versions of Xapian which support posting
+sources; otherwise, the names in this module are set to None.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import time
+import xapian
+
+if hasattr(xapian, 'PostingSource'):
+    class DocidSetPostingSource(xapian.PostingSource):
+        """A posting source returning the documents in a DocidSet.
+
+        DocidSet is defined in the filtercache module.
+
+        All the documents are given a weight of 0.
+
+        """
+        def __init__(self, docids):
+            xapian.PostingSource.__init__(self)
+            self.docids = docids
+            self.current = 0
+
+        def init(self, db):
+            self.current = 0
+
+        def get_termfreq_min(self):
+            return len(self.docids)
+
+        def get_termfreq_est(self):
+            return len(self.docids)
+
+        def get_termfreq_max(self):
+            return len(self.docids)
+
+        def next(self, minweight):
+            self.current = self.docids.next_from(self.current + 1)
+
+        def skip_to(self, did, minweight):
+            if did > self.current:
+                self.current = self.docids.next_from(did)
+
+        def at_end(self):
+            return self.current is None
+
+        def get_docid(self):
+            return self.current
+
+    class DocidRangePostingSource(xapian.PostingSource):
+        """A posting source returning all document IDs from `start` onwards.
+
+        Document IDs which aren't in use may be returned, so this is only
+        suitable for filtering other queries.  All the documents are given a
+        weight of 0.
+
+        """
+        def __init__(self, start):
+            xapian.PostingSource.__init__(self)
+            self.start = start
+
+        def init(self, db):
+            self.lastdocid = db.get_lastdocid()
+            self.current = self.start - 1
+            self.termfreq = max(0, min(db.get_doccount(),
+                                       self.lastdocid - self.start + 1))
+
+        def get_termfreq_min(self):
+            return 0
+
+        def get_termfreq_est(self):
+            return self.termfreq
+
+        def get_termfreq_max(self):
+            return self.termfreq
+
+        def next(self, minweight):
+            self.current += 1
+
+        def skip_to(self, did, minweight):
+            if did > self.current:
+                self.current = did
+
+        def at_end(self):
+            return self.current > self.lastdocid
+
+        def get_docid(self):
+            return self.current
+
+    class DeadlinePostingSource(DocidRangePostingSource):
+        """A posting source returning all document IDs, until a time limit.
+
+        Used to filter a query, this stops the match once `time_limit`
+        seconds have passed since the match started: from then on, the
+        source reports that it has reached its end, so no further documents
+        can match.  `expired` is set to True if this happens before every
+        document has been considered.
+
+        """
+        def __init__(self, time_limit):
+            DocidRangePostingSource.__init__(self, 1)
+            self.time_limit = time_limit
+            self.expired = False
+
+        def init(self, db):
+            DocidRangePostingSource.init(self, db)
+            self.deadline = time.time() + self.time_limit
+            self.expired = False
+
+        def _check(self):
+            if self.current <= self.lastdocid and \
+               time.time() >= self.deadline:
+                self.expired = True
+
+        def next(self, minweight):
+            self.current += 1
+            self._check()
+
+        def skip_to(self, did, minweight):
+            if did > self.current:
+                self.current = did
+                self._check()
+
+        def at_end(self):
+            return self.expired or self.current > self.lastdocid
+else:
+    DocidSetPostingSource = None
+    DocidRangePostingSource = None
+    DeadlinePostingSource = None
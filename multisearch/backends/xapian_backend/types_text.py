@@ -105,8 +105,8 @@ class XapianTextQueryGenerator(object):
 
         self.lang = str(params.get('lang', ''))
         if self.lang:
-            self.qp.set_stemmer(xapian.Stem(lang))
-            self.qp.set_stemming_strategy(qp.STEM_SOME)
+            self.qp.set_stemmer(xapian.Stem(self.lang))
+            self.qp.set_stemming_strategy(self.qp.STEM_SOME)
 
         self.baseflags = (xapian.QueryParser.FLAG_LOVEHATE |
                           xapian.QueryParser.FLAG_PHRASE |
@@ -53,3 +53,16 @@ class XapianQuery(multisearch.queries.Query):
 
     def __str__(self):
         return u'<%s>' % (self.xapq, )
+
+    def canonical(self):
+        """Get the canonical form of the query.
+
+        This is built from the method and parameters used to create the query,
+        if they were recorded, or from the description of the Xapian query
+        otherwise.
+
+        """
+        if self.method is None:
+            return (u'XAPIAN', None, self.xapq.get_description())
+        return (u'XAPIAN', self.method, multisearch.queries._freeze(self.args),
+                multisearch.queries._freeze(self.kwargs))
@@ -112,6 +112,29 @@ class BaseSearchClient(object):
         """
         raise NotImplementedError
 
+    def get_documents(self, docids):
+        """Get several documents, given a sequence of document IDs.
+
+        Returns a list of the documents, in the same order as `docids`, with
+        None in place of any documents which do not exist.
+
+        """
+        result = []
+        for docid in docids:
+            try:
+                result.append(self.get_document(docid))
+            except KeyError:
+                result.append(None)
+        return result
+
+    def document_exists_many(self, docids):
+        """Check whether several documents exist.
+
+        Returns a list of booleans, in the same order as `docids`.
+
+        """
+        return [self.document_exists(docid) for docid in docids]
+
     def query(self, value, fieldname=None, *args, **kwargs):
         """Create a basic search for the value supplied.
 
@@ -140,6 +163,49 @@ class BaseSearchClient(object):
         """
         raise NotImplementedError
 
+    def count(self, query, params, exact=False):
+        """Count the documents matching a search.
+
+        Returns a multisearch.queries.MatchCount.  See Search.count() for the
+        meaning of `exact`.
+
+        This default implementation performs a search for an empty page of
+        results, and ignores `exact`; backends should override it if they
+        can control the accuracy of the count.
+
+        """
+        params = dict(params, start_rank=0, end_rank=0)
+        params.pop('search_after', None)
+        results = self.search(query, params)
+        return multisearch.queries.MatchCount(results.matches_lower_bound,
+                                              results.matches_estimated,
+                                              results.matches_upper_bound)
+
+    def scan(self, query, params, batch_size):
+        """Iterate through all the results of a search, in batches.
+
+        Yields lists of up to `batch_size` results.  The results are returned
+        in no particular order, and the rank and cursor parameters in
+        `params` are ignored.
+
+        This default implementation simply pages through the results with
+        search(); backends should override it if they can avoid ranking the
+        results.
+
+        """
+        params = dict(params)
+        params.pop('search_after', None)
+        start_rank = 0
+        while True:
+            params['start_rank'] = start_rank
+            params['end_rank'] = start_rank + batch_size
+            batch = list(self.search(query, params))
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                return
+            start_rank += batch_size
+
     def flush(self):
         """Empty any buffered changes; this minimises memory use, but does not
         force changes to be committed (ie, to become visible in searches).
@@ -164,6 +230,26 @@ class BaseSearchClient(object):
     def update(self, doc, docid=None, fail_if_exists=False, assume_new=False):
         raise multisearch.errors.FeatureNotAvailableError
 
+    def update_many(self, docs, fail_if_exists=False, assume_new=False):
+        """Add or update a sequence of documents.
+
+        `docs` is an iterable of (docid, doc) pairs.  `docid` may be None, in
+        which case an identifier will be allocated automatically.  The
+        `fail_if_exists` and `assume_new` parameters have the same meaning as
+        for update().
+
+        Returns an iterator over the document IDs used for each document, in
+        the order in which the documents were supplied.  Documents are
+        processed as this iterator is consumed, so it must be exhausted for
+        all the documents to be added.
+
+        This default implementation simply calls update() for each document;
+        backends may override it to handle documents in batches.
+
+        """
+        for docid, doc in docs:
+            yield self.update(doc, docid, fail_if_exists, assume_new)
+
     def delete(self, docid, fail_if_missing=False):
         raise multisearch.errors.FeatureNotAvailableError
 
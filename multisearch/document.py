@@ -22,6 +22,10 @@ r"""Documents, and associated objects.
 """
 __docformat__ = "restructuredtext en"
 
+import copy
+import multisearch.errors
+import multisearch.utils
+
 class Term(object):
     """A term returned from a list of terms.
 
@@ -67,13 +71,55 @@ class Document(object):
         This consists of a dict of field values which were passed in which the
         schema caused to be stored.
 
-        The data returned by this data shouldn't be modified (the effect of
-        modifying it will vary depending on the backend, and is not the
-        appropriate way to modify a document).
+        The data returned must not be modified.  Backends may parse the data
+        once and return the same dict every time it's requested, and a
+        document may be shared between several users (for example, when it's
+        part of a set of cached search results), so a modification would be
+        seen by every other user of the document.  Modifying the data is also
+        not the appropriate way to modify a document.  Use `copy_data()` to
+        get a copy which may be modified.
 
         """
         return self.get_data()
 
+    def copy_data(self):
+        """Get a (deep) copy of the data stored in the document.
+
+        Unlike the `data` property, the result may be freely modified.
+
+        """
+        return copy.deepcopy(self.get_data())
+
+    @property
+    def data_json(self):
+        """The data stored in the document, as a JSON string.
+
+        Backends which store the data as JSON return it without decoding it,
+        so this is the cheapest way to pass the data on to something which
+        wants JSON (such as the response to an HTTP request).
+
+        """
+        return self.get_data_json()
+
+    def detach(self):
+        """Get a copy of the document's ID and stored data.
+
+        Returns a DetachedDocument, which holds no references to the client
+        or database the document came from, so it may be used after the
+        client has been closed, or by a different thread.  The rank, if the
+        document came from a set of search results, is kept.
+
+        """
+        return DetachedDocument(self.get_docid(), self.get_data_json(),
+                                getattr(self, 'rank', None))
+
+    def get_data_json(self):
+        """Get the data stored in the document, as a JSON string.
+
+        """
+        return multisearch.utils.json.dumps(self.get_data(),
+                                            separators=(',', ':'))
+
     @property
     def terms(self):
         """The terms stored in the document.
@@ -89,3 +135,28 @@ class Document(object):
 
     def __repr__(self):
         return "<multisearch.Document(docid=%r)>" % self.docid
+
+class DetachedDocument(Document):
+    """A copy of the ID and stored data of a document.
+
+    The data is held as JSON, and parsed the first time it's needed.  The
+    document's terms aren't available.
+
+    """
+    def __init__(self, docid, data_json, rank=None):
+        self._docid = docid
+        self._data = multisearch.utils.LazyJsonObject(json=data_json)
+        self.rank = rank
+
+    def get_docid(self):
+        return self._docid
+
+    def get_data(self):
+        return self._data.data
+
+    def get_data_json(self):
+        return self._data.json
+
+    def get_terms(self):
+        raise multisearch.errors.FeatureNotAvailableError(
+            "The terms of a detached document are not available")
@@ -82,3 +82,16 @@ class BackendError(SearchClientError):
 
     """
     pass
+
+class ExecutorBusyError(SearchClientError):
+    """A call was submitted to an executor which already had as many calls
+    queued as it allows.
+
+    """
+    pass
+
+class TimeoutError(SearchClientError):
+    """A wait for a call to finish timed out.
+
+    """
+    pass
@@ -23,7 +23,23 @@ r"""Abstract definitions of queries and searches.
 """
 __docformat__ = "restructuredtext en"
 
+import hashlib
 import multisearch.errors
+from multisearch.utils import json
+
+def _freeze(value):
+    """Convert a value to a hashable form, for use in a canonical query.
+
+    Lists become tuples, and dictionaries become tuples of (key, value) pairs,
+    sorted by key.
+
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item))
+                            for key, item in value.iteritems()))
+    return value
 
 class Query(object):
     """Base class of all queries.
@@ -31,6 +47,10 @@ class Query(object):
     All queries have the "op" member, which is used to identify the type
     of the query.
 
+    Queries can be compared with each other, and hashed, according to their
+    canonical form (see `canonical()`), so two queries which are built in
+    different ways but are structurally the same are equal.
+
     """
     op = None
     conn = None
@@ -41,6 +61,66 @@ class Query(object):
     def __repr__(self):
         return u"Query()"
 
+    def canonical(self):
+        """Get the canonical form of the query.
+
+        This is a nested tuple of strings and numbers, which is the same for
+        any two queries which have the same structure, regardless of the
+        order in which the subqueries of commutative operators were given.
+        The connection which the query is attached to is not part of the
+        canonical form.
+
+        """
+        return (u'QUERY', )
+
+    def serialise(self):
+        """Serialise the canonical form of the query to a string.
+
+        """
+        return json.dumps(self.canonical(), separators=(',', ':'))
+
+    def fingerprint(self):
+        """Get a hash of the structure of the query, as a hex string.
+
+        Unlike the value returned by hash(), this is stable across processes
+        and platforms.
+
+        """
+        return hashlib.sha1(self.serialise()).hexdigest()
+
+    def optimise(self):
+        """Get a query which is equivalent to this one, but simpler.
+
+        The returned query matches the same documents, with the same weights,
+        but may have fewer nodes: nested ANDs and ORs are flattened, redundant
+        subqueries are removed, and stacked weight multipliers are combined.
+        Parts of the query which can't be simplified are shared with the
+        original query, and the original query is not modified.
+
+        """
+        return self
+
+    def _connected(self, query):
+        """Connect a query built from this one to the same connection.
+
+        """
+        if self.conn is not None:
+            query.connect(self.conn)
+        return query
+
+    def __eq__(self, other):
+        if not isinstance(other, Query):
+            return NotImplemented
+        return self.canonical() == other.canonical()
+
+    def __ne__(self, other):
+        if not isinstance(other, Query):
+            return NotImplemented
+        return self.canonical() != other.canonical()
+
+    def __hash__(self):
+        return hash(self.canonical())
+
     # Constants used to represent the operators.
     OR = 0
     AND = 1
@@ -52,19 +132,21 @@ class Query(object):
     TERMS = 7
     SIMILAR = 8
     AND_MAYBE = 9
+    FILTER = 10
 
     # The names of the operators, in order.
     OP_NAMES = (u'OR', u'AND', u'XOR', u'NOT',
                 u'MULTWEIGHT',
                 u'ALL', u'NONE',
                 u'TERMS', u'SIMILAR',
-                u'AND_MAYBE',
+                u'AND_MAYBE', u'FILTER',
                )
 
     # Symbols representing the operators, in order.  None if no symbol.
     OP_SYMS = (u'|', u'&', u'^', u'-',
                None,
                None, None,
+               None, None,
                None, None,)
 
     @staticmethod
@@ -189,8 +271,11 @@ class Query(object):
     def filter(self, other):
         """Return a query filtered by another query.
 
+        The result matches only documents which match both queries, but
+        `other` does not contribute to the weights.
+
         """
-        return QueryAnd((self, other * 0))
+        return QueryFilter((self, other))
 
     def and_maybe(self, other):
         """Return a query with weights added from another query.
@@ -237,13 +322,71 @@ class QueryCombination(Query):
                 self.connect(query.conn)
 
     def __unicode__(self):
-        joinsym = u' ' + Query.opsym(self.op) + u' '
+        joinsym = u' ' + (Query.opsym(self.op) or Query.opname(self.op)) + u' '
         return u'(' + joinsym.join(unicode(q) for q in self.subqs) + u')'
 
     def __repr__(self):
-        joinsym = ' ' + Query.opsym(self.op) + ' '
+        joinsym = ' ' + (Query.opsym(self.op) or Query.opname(self.op)) + ' '
         return '(' + joinsym.join(repr(q) for q in self.subqs) + ')'
 
+    # True if the order of the subqueries makes no difference to the results.
+    commutative = False
+
+    def canonical(self):
+        subqs = [subq.canonical() for subq in self.subqs]
+        if self.commutative:
+            subqs.sort()
+        return (Query.opname(self.op), tuple(subqs))
+
+    def optimise(self):
+        subqs = [subq.optimise() for subq in self.subqs]
+        return self._rebuild(subqs)
+
+    def _rebuild(self, subqs):
+        """Get a query like this one, but with the given subqueries.
+
+        Returns this query if the subqueries are unchanged.
+
+        """
+        if len(subqs) == len(self.subqs) and \
+           all(new is old for new, old in zip(subqs, self.subqs)):
+            return self
+        return self._connected(self.__class__(subqs))
+
+    def _flatten(self, drop, absorb=None):
+        """Optimise an associative combination of queries.
+
+        Subqueries which are combinations of the same type are merged into
+        this one, subqueries whose op is `drop` are removed, and if `absorb`
+        is not None and any subquery's op is `absorb`, that subquery is
+        returned in place of the whole combination.
+
+        """
+        subqs = []
+        # Nested combinations of the same type are expanded here, rather than
+        # by optimising them recursively, so that a long chain built with
+        # binary operators is flattened in linear time.
+        pending = list(reversed(self.subqs))
+        while pending:
+            subq = pending.pop()
+            if subq.op == self.op:
+                pending.extend(reversed(subq.subqs))
+                continue
+            subq = subq.optimise()
+            if subq.op == self.op:
+                subqs.extend(subq.subqs)
+            elif absorb is not None and subq.op == absorb:
+                return subq
+            elif subq.op != drop:
+                subqs.append(subq)
+        if len(subqs) == 0:
+            if drop == Query.ALL:
+                return self._connected(QueryAll())
+            return self._connected(QueryNone())
+        if len(subqs) == 1:
+            return subqs[0]
+        return self._rebuild(subqs)
+
 class QueryOr(QueryCombination):
     """A query which matches a document if any of its subqueries match.
 
@@ -252,6 +395,10 @@ class QueryOr(QueryCombination):
 
     """
     op = Query.OR
+    commutative = True
+
+    def optimise(self):
+        return self._flatten(Query.NONE)
 
 class QueryAnd(QueryCombination):
     """A query which matches a document if all of its subqueries match.
@@ -261,6 +408,10 @@ class QueryAnd(QueryCombination):
 
     """
     op = Query.AND
+    commutative = True
+
+    def optimise(self):
+        return self._flatten(Query.ALL, Query.NONE)
 
 class QueryAndMaybe(QueryCombination):
     """A query which matches a document if its left subquery matches.
@@ -271,6 +422,46 @@ class QueryAndMaybe(QueryCombination):
     """
     op = Query.AND_MAYBE
 
+class QueryFilter(QueryCombination):
+    """A query which matches a document if all of its subqueries match.
+
+    The weights for the returned query will be the weights of the first
+    subquery: the other subqueries are purely boolean filters.
+
+    """
+    op = Query.FILTER
+
+    def canonical(self):
+        subqs = [subq.canonical() for subq in self.subqs]
+        return (Query.opname(self.op), (subqs[0], ) + tuple(sorted(subqs[1:])))
+
+    def optimise(self):
+        query = self.subqs[0].optimise()
+        filters = []
+        pending = list(reversed(self.subqs[1:]))
+        if query.op == Query.FILTER:
+            pending.extend(reversed(query.subqs[1:]))
+            query = query.subqs[0]
+        if query.op == Query.NONE:
+            return query
+        while pending:
+            subq = pending.pop()
+            # Weights of filters are ignored, so multipliers can be removed,
+            # and filters which are ANDs can be split up.
+            while subq.op == Query.MULTWEIGHT:
+                subq = subq.subq
+            if subq.op in (Query.AND, Query.FILTER):
+                pending.extend(reversed(subq.subqs))
+                continue
+            subq = subq.optimise()
+            if subq.op == Query.NONE:
+                return self._connected(QueryNone())
+            if subq.op != Query.ALL:
+                filters.append(subq)
+        if not filters:
+            return query
+        return self._rebuild([query] + filters)
+
 class QueryXor(QueryCombination):
     """A query which matches a document if an odd number of its subqueries match.
 
@@ -279,6 +470,7 @@ class QueryXor(QueryCombination):
 
     """
     op = Query.XOR
+    commutative = True
 
 class QueryNot(QueryCombination):
     """A query which matches a document if its first subquery matches but none
@@ -304,22 +496,41 @@ class QueryMultWeight(Query):
         self.subq = subq
         self.mult = float(mult)
         super(QueryMultWeight, self).__init__()
+        if subq.conn is not None:
+            self.connect(subq.conn)
     def __unicode__(self):
         return u"(%s * %.4g)" % (unicode(self.subq), self.mult)
     def __repr__(self):
         return "(%s * %.4g)" % (repr(self.subq), self.mult)
+    def canonical(self):
+        return (u'MULTWEIGHT', self.mult, self.subq.canonical())
+    def optimise(self):
+        subq = self.subq.optimise()
+        mult = self.mult
+        if subq.op == Query.MULTWEIGHT:
+            mult *= subq.mult
+            subq = subq.subq
+        if subq.op == Query.NONE or mult == 1:
+            return subq
+        if subq is self.subq and mult == self.mult:
+            return self
+        return self._connected(QueryMultWeight(subq, mult))
 
 class QueryAll(Query):
     """A query which matches all documents.
 
     """
     op = Query.ALL
+    def canonical(self):
+        return (u'ALL', )
 
 class QueryNone(Query):
     """A query which matches no documents.
 
     """
     op = Query.NONE
+    def canonical(self):
+        return (u'NONE', )
 
 class QueryTerms(Query):
     """A query which returns the documents containing a set of terms.
@@ -352,6 +563,9 @@ class QueryTerms(Query):
     def __repr__(self):
         return ("QueryTerms(%r, default_op=%s)" %
                 (self.terms, Query.opname(self.default_op)))
+    def canonical(self):
+        return (u'TERMS', Query.opname(self.default_op),
+                tuple(sorted(self.terms)))
 
 class QuerySimilar(Query):
     """A query which returns similar documents to a given set of documents.
@@ -379,6 +593,35 @@ class QuerySimilar(Query):
         return u"QuerySimilar(%r)" % (self.ids, )
     def __repr__(self):
         return "QuerySimilar(%r)" % (self.ids, )
+    def canonical(self):
+        return (u'SIMILAR', tuple(sorted(self.ids)), self.simterms)
+
+class MatchCount(object):
+    """The number of documents matching a search.
+
+    `lower_bound` and `upper_bound` are bounds on the number of matching
+    documents, and `estimated` is the best estimate of the number, which is
+    also the value returned by int().
+
+    """
+    def __init__(self, lower_bound, estimated, upper_bound):
+        self.lower_bound = lower_bound
+        self.estimated = estimated
+        self.upper_bound = upper_bound
+
+    @property
+    def exact(self):
+        """True if the number of matching documents is known exactly.
+
+        """
+        return self.lower_bound == self.upper_bound
+
+    def __int__(self):
+        return self.estimated
+
+    def __repr__(self):
+        return "MatchCount(%d, %d, %d)" % (self.lower_bound, self.estimated,
+                                           self.upper_bound)
 
 class Search(object):
     def __init__(self, query, start_rank=0, end_rank=10, **kwargs):
@@ -435,6 +678,139 @@ class Search(object):
         self._results = None
         return self
 
+    def ids_only(self):
+        """Return only the IDs of the matching documents.
+
+        Iterating through the results will yield document IDs, rather than
+        document objects.  Backends can often avoid loading the documents at
+        all in this mode.
+
+        """
+        self.params['result_mode'] = 'ids'
+        self.params.pop('fields', None)
+        self._results = None
+        return self
+
+    def fields(self, fieldnames):
+        """Return only some of the stored fields of the matching documents.
+
+        Iterating through the results will yield (docid, data) pairs, rather
+        than document objects, where `data` is a dictionary holding the stored
+        values of only the fields listed in `fieldnames` (any of the fields
+        which have no stored values for a document will be missing from the
+        dictionary).
+
+        """
+        self.params['result_mode'] = 'fields'
+        self.params['fields'] = tuple(fieldnames)
+        self._results = None
+        return self
+
+    def count(self, exact=False):
+        """Count the documents matching the search, without fetching any.
+
+        Returns a MatchCount.  `exact` controls the trade-off between the
+        accuracy of the count and the time taken to calculate it:
+
+         - False: return whatever bounds and estimate can be calculated
+           cheaply.
+         - True: count the matching documents exactly.
+         - An integer N: count exactly if there are at most N matching
+           documents, and otherwise ensure that the lower bound is at least
+           N.
+
+        The start and end ranks, the ordering and any cursor are ignored.
+
+        """
+        if self.query.conn is None:
+            raise multisearch.errors.SearchClientError(
+                "Query was not connected to a database - can't execute it.")
+        return self.query.conn.count(self.query, self.params, exact)
+
+    def scan(self, batch_size=1000):
+        """Iterate through all the results of the search, in batches.
+
+        Yields lists of up to `batch_size` results, which are documents, IDs
+        or (docid, data) pairs, according to the result mode (see ids_only()
+        and fields()).  Every document matching the query and filters is
+        returned, in no particular order: the start and end ranks, the
+        ordering and any cursor are ignored.  Backends which support it avoid
+        ranking the results, and use memory bounded by the batch size.
+
+        """
+        if self.query.conn is None:
+            raise multisearch.errors.SearchClientError(
+                "Query was not connected to a database - can't execute it.")
+        return self.query.conn.scan(self.query, self.params, batch_size)
+
+    def timeout(self, seconds):
+        """Set a time limit for the search, in seconds.
+
+        If the search takes longer than this, the backend stops looking for
+        better results, and returns the best results found so far, with the
+        `timed_out` property of the results set to True.  If None, the
+        client's default time limit (if any) is used.  Backends which can't
+        apply time limits raise FeatureNotAvailableError when the search is
+        performed.
+
+        """
+        if seconds is None:
+            self.params.pop('timeout', None)
+        else:
+            self.params['timeout'] = seconds
+        self._results = None
+        return self
+
+    def deadline(self, when):
+        """Set a deadline for the search, as a time as returned by time.time().
+
+        This works like timeout(), but with the time limit being the time
+        remaining until the deadline when the search is performed.  If both a
+        timeout and a deadline are set, whichever expires first applies.
+
+        """
+        if when is None:
+            self.params.pop('deadline', None)
+        else:
+            self.params['deadline'] = when
+        self._results = None
+        return self
+
+    def search_after(self, cursor):
+        """Return the results which follow those a cursor was taken from.
+
+        `cursor` is the `cursor` property of a previous set of results for the
+        same search (or None, to start from the beginning).  The number of
+        results returned is still end_rank - start_rank, but they start
+        immediately after the results the cursor was taken from, rather than
+        at start_rank.  For backends which support it, this is much cheaper
+        than setting start_rank when paging deep into a set of results.
+
+        """
+        if cursor is None:
+            self.params.pop('search_after', None)
+        else:
+            self.params['search_after'] = cursor
+        self._results = None
+        return self
+
+    def filter(self, query):
+        """Restrict the results to documents matching a query.
+
+        The filter is kept separate from the query being searched for: it
+        does not affect the weights of the results, and backends may be able
+        to check it more cheaply than they could if it were part of the
+        query.  Multiple filters may be added; documents must match all of
+        them.
+
+        """
+        if not isinstance(query, Query):
+            raise TypeError("Object supplied to Search.filter() was not a "
+                            "Query.")
+        self.params['filters'] = self.params.get('filters', ()) + (query, )
+        self._results = None
+        return self
+
     @property
     def results(self):
         if self._results is None:
@@ -464,7 +840,7 @@ class Search(object):
         return "Search(%s)" % r
 
 
-query_types = 'Query,QueryOr,QueryAnd,QueryXor,QueryNot,' \
+query_types = 'Query,QueryOr,QueryAnd,QueryXor,QueryNot,QueryFilter,' \
               'QueryMultWeight,QueryAll,QueryNone,QueryTerms,' \
               'QuerySimilar'
 query_types = [(q, globals()[q]) for q in query_types.split(',')]
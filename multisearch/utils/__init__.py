@@ -24,4 +24,12 @@ __docformat__ = "restructuredtext en"
 
 from multisearch.utils.lazyjson import json, LazyJsonObject
 from multisearch.utils.validation import is_safe_backend_name
-from multisearch.utils.docprocessing import iter_doc_fields, make_docid
+from multisearch.utils.commitpolicy import CommitPolicy
+from multisearch.utils.lrucache import LRUCache
+from multisearch.utils.executor import Future, SearchExecutor, \
+     DetachedResults
+from multisearch.utils.datacodec import encode_data, decode_data, \
+     decode_fields, data_json
+from multisearch.utils.docprocessing import iter_doc_fields, iter_batches, \
+     doc_size, make_docid, DocidAllocator, RandomDocidAllocator, \
+     SequentialDocidAllocator, TimeOrderedDocidAllocator
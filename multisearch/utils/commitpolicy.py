@@ -0,0 +1,86 @@
+# Copyright (c) 2010 Richard Boulton
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+r"""Policies for automatically committing changes.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import time
+
+class CommitPolicy(object):
+    """A policy deciding when buffered changes should be committed.
+
+    A commit is due as soon as any of the following limits is reached (limits
+    which are None are ignored):
+
+     - `max_docs`: the number of documents added, replaced or deleted since
+       the last commit.
+     - `max_bytes`: the approximate size of the documents processed since the
+       last commit, as calculated by multisearch.utils.doc_size().
+     - `max_seconds`: the time since the first change after the last commit.
+       This is only checked when a change is made, so a commit will not
+       happen while no changes are being made.
+
+    Each commit has a fixed cost (for disk based backends, typically a few
+    disk syncs), so low limits reduce indexing throughput, while the memory
+    used to buffer changes grows until the next commit.  `max_bytes` is the
+    most direct way of bounding the memory used; `max_docs` is cheaper to
+    track, but the memory used per document varies with document size.
+
+    """
+    def __init__(self, max_docs=None, max_bytes=None, max_seconds=None):
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.reset()
+
+    @property
+    def measures_bytes(self):
+        """True if the policy needs to know the size of documents.
+
+        """
+        return self.max_bytes is not None
+
+    def reset(self):
+        """Record that all changes have been committed.
+
+        """
+        self.docs = 0
+        self.bytes = 0
+        self.started = None
+
+    def record(self, docs=1, nbytes=0):
+        """Record that changes have been made.
+
+        Returns True if a commit is now due.
+
+        """
+        if self.started is None:
+            self.started = time.time()
+        self.docs += docs
+        self.bytes += nbytes
+        if self.max_docs is not None and self.docs >= self.max_docs:
+            return True
+        if self.max_bytes is not None and self.bytes >= self.max_bytes:
+            return True
+        if self.max_seconds is not None and \
+           time.time() - self.started >= self.max_seconds:
+            return True
+        return False
@@ -0,0 +1,179 @@
+# Copyright (c) 2010 Richard Boulton
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+r"""Encoding of the data stored in documents.
+
+Stored data is a dictionary mapping field names to lists of values.  It can be
+encoded in one of the following formats (or "codecs"):
+
+ - "json": a JSON object.
+ - "indexed": a JSON object, followed by a binary index giving the position
+   and length of the values of each field.  The whole object can be decoded
+   as quickly as plain JSON, but a single field can also be decoded without
+   parsing the values of any other fields.
+ - "indexed-zlib": the indexed format, compressed with zlib.  This saves
+   space for documents with large amounts of stored text, at the cost of
+   decompressing the data before decoding any of it.
+
+The values themselves are always encoded as JSON, because the C JSON decoder
+is faster than any binary format which would have to be decoded in Python.
+
+Encoded data is self-describing: a JSON object always begins with "{", and
+the indexed format begins with a byte which can't start JSON, so data can be
+decoded without knowing which codec was used to encode it.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import struct
+import zlib
+from multisearch.utils.lazyjson import json
+
+CODECS = ('json', 'indexed', 'indexed-zlib')
+
+# The first byte of data in the indexed format, and the flags which may
+# follow it.
+INDEXED_MAGIC = '\x01'
+FLAG_ZLIB = 0x01
+
+_uint = struct.Struct('>I')
+_index_entry = struct.Struct('>HII')
+_decoder = json.JSONDecoder()
+
+def check_codec(codec):
+    """Check that a codec name is valid.
+
+    Raises ValueError if it isn't.
+
+    """
+    if codec not in CODECS:
+        raise ValueError("Unknown data codec %r: valid codecs are %s" %
+                         (codec, ', '.join(CODECS)))
+
+def encode_data(data, codec='json'):
+    """Encode a dictionary of stored data with the named codec.
+
+    """
+    if codec == 'json':
+        return json.dumps(data, separators=(',', ':'))
+    check_codec(codec)
+
+    # The JSON encoder escapes all non-ascii characters by default, so
+    # offsets in characters are also offsets in bytes.
+    parts = ['{']
+    entries = [_uint.pack(len(data))]
+    names = []
+    pos = 1
+    for fieldname, values in data.iteritems():
+        key = json.dumps(fieldname) + ':'
+        if len(parts) > 1:
+            key = ',' + key
+        encoded = json.dumps(values, separators=(',', ':'))
+        pos += len(key)
+        if isinstance(fieldname, unicode):
+            fieldname = fieldname.encode('utf-8')
+        entries.append(_index_entry.pack(len(fieldname), pos, len(encoded)))
+        names.append(fieldname)
+        parts.append(key)
+        parts.append(encoded)
+        pos += len(encoded)
+    parts.append('}')
+    pos += 1
+    body = ''.join(parts + entries + names) + _uint.pack(pos)
+
+    if codec == 'indexed-zlib':
+        return INDEXED_MAGIC + chr(FLAG_ZLIB) + zlib.compress(body)
+    return INDEXED_MAGIC + chr(0) + body
+
+def _indexed_body(raw):
+    """Get the body of data in the indexed format.
+
+    Returns (body, base), where `base` is the offset of the start of the body
+    in `body`.  This avoids copying data which isn't compressed.
+
+    """
+    if ord(raw[1]) & FLAG_ZLIB:
+        return zlib.decompress(raw[2:]), 0
+    return raw, 2
+
+def decode_data(raw):
+    """Decode stored data, in any of the supported formats.
+
+    """
+    if not raw:
+        return {}
+    if raw[0] != INDEXED_MAGIC:
+        return json.loads(raw)
+    body, base = _indexed_body(raw)
+    return _decoder.raw_decode(body, base)[0]
+
+def data_json(raw):
+    """Get stored data, in any of the supported formats, as a JSON string.
+
+    The data is not parsed: for the "json" codec, `raw` is returned unchanged,
+    and for the indexed codecs the JSON object is extracted from it.
+
+    """
+    if not raw:
+        return '{}'
+    if raw[0] != INDEXED_MAGIC:
+        return raw
+    body, base = _indexed_body(raw)
+    end = base + _uint.unpack_from(body, len(body) - _uint.size)[0]
+    return body[base:end]
+
+def decode_fields(raw, fieldnames):
+    """Decode the values of some fields from stored data.
+
+    Returns a dictionary keyed by fieldname, containing only those of the
+    requested fields which are present.  For data in the indexed format, the
+    values of other fields are not decoded.
+
+    """
+    if not raw:
+        return {}
+    if raw[0] != INDEXED_MAGIC:
+        data = json.loads(raw)
+        return dict((fieldname, data[fieldname])
+                    for fieldname in fieldnames
+                    if fieldname in data)
+
+    wanted = {}
+    for fieldname in fieldnames:
+        if isinstance(fieldname, unicode):
+            wanted[fieldname.encode('utf-8')] = fieldname
+        else:
+            wanted[fieldname] = fieldname
+    body, base = _indexed_body(raw)
+    index = base + _uint.unpack_from(body, len(body) - _uint.size)[0]
+    count = _uint.unpack_from(body, index)[0]
+    entry = index + _uint.size
+    name = entry + count * _index_entry.size
+    result = {}
+    raw_decode = _decoder.raw_decode
+    for i in xrange(count):
+        namelen, offset, length = _index_entry.unpack_from(body, entry)
+        fieldname = wanted.get(body[name:name + namelen])
+        if fieldname is not None:
+            result[fieldname] = raw_decode(body, base + offset)[0]
+            if len(result) == len(wanted):
+                break
+        entry += _index_entry.size
+        name += namelen
+    return result
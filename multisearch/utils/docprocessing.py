@@ -22,6 +22,8 @@ r"""Document processing routines.
 """
 __docformat__ = "restructuredtext en"
 
+import abc
+import time
 import uuid
 
 def iter_doc_fields(doc):
@@ -44,6 +46,127 @@ def iter_doc_fields(doc):
     for fieldname, values in it:
         yield (fieldname, values)
 
+def doc_size(doc):
+    """Calculate the approximate size of a document, in bytes.
+
+    This is the total length of the field names and values; values which are
+    not strings are measured by the length of their string representation.
+
+    """
+    size = 0
+    for fieldname, values in iter_doc_fields(doc):
+        size += len(fieldname)
+        if isinstance(values, basestring):
+            size += len(values)
+            continue
+        try:
+            values = iter(values)
+        except TypeError:
+            size += len(str(values))
+            continue
+        for value in values:
+            if isinstance(value, basestring):
+                size += len(value)
+            else:
+                size += len(str(value))
+    return size
+
+def iter_batches(iterable, batch_size):
+    """Split an iterable into lists of at most `batch_size` items.
+
+    The iterable is consumed lazily, so this may be used with unbounded
+    streams of items.
+
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 def make_docid():
     docid = uuid.uuid4().hex
     return docid
+
+class DocidAllocator(object):
+    """Abstract base class of document ID allocators.
+
+    Subclasses must implement __call__(), which is called with no arguments
+    and returns a new document ID (as a str) each time it is called.  They
+    should set `unique` to True if the IDs returned are unique by
+    construction, so need not be checked against the IDs already in use;
+    otherwise, the writer checks each ID before using it.
+
+    The base class can't be instantiated, nor can any subclass which doesn't
+    implement __call__().
+
+    """
+    __metaclass__ = abc.ABCMeta
+
+    unique = False
+
+    @abc.abstractmethod
+    def __call__(self):
+        """Return a new document ID.
+
+        """
+
+class RandomDocidAllocator(DocidAllocator):
+    """Allocate random IDs, using make_docid().
+
+    Collisions are very unlikely, but not impossible, so the IDs should be
+    checked before use.
+
+    """
+    def __call__(self):
+        return make_docid()
+
+class SequentialDocidAllocator(DocidAllocator):
+    """Allocate sequential IDs, with a fixed prefix.
+
+    Each ID is the prefix followed by a counter, written as a fixed width hex
+    number, so IDs sort in the order in which they were allocated.  The IDs
+    are unique provided that the prefix is not used by any other writer (or
+    by any previous allocator with an overlapping range of counter values),
+    and that no IDs starting with the prefix are supplied explicitly.
+
+    """
+    unique = True
+
+    def __init__(self, prefix, start=0, width=12):
+        self.prefix = str(prefix)
+        self.next = int(start)
+        self.width = int(width)
+
+    def __call__(self):
+        docid = '%s%0*x' % (self.prefix, self.width, self.next)
+        self.next += 1
+        return docid
+
+class TimeOrderedDocidAllocator(DocidAllocator):
+    """Allocate IDs which increase with time.
+
+    Each ID is a fixed width hex timestamp, in microseconds, followed by a
+    node identifier.  The timestamp is forced to increase for each ID
+    allocated, so the IDs from an allocator are unique and sorted.  The node
+    identifier distinguishes the IDs from different allocators: by default,
+    it is chosen randomly when the allocator is created, but a value known to
+    be unique (eg, derived from a host name and process ID) may be supplied
+    instead.
+
+    """
+    unique = True
+
+    def __init__(self, node=None):
+        if node is None:
+            node = uuid.uuid4().hex[:8]
+        self.node = str(node)
+        self.last = 0
+
+    def __call__(self):
+        now = max(int(time.time() * 1000000), self.last + 1)
+        self.last = now
+        return '%014x%s' % (now, self.node)
@@ -0,0 +1,369 @@
+# Copyright (c) 2010 Richard Boulton
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+r"""Running searches on a bounded pool of threads.
+
+Searching blocks the calling thread until the backend has found the results,
+which stalls a server handling many requests with an event loop.  A
+SearchExecutor runs searches and document fetches in a fixed number of
+worker threads, and returns a Future for each one, which the event loop can
+wait on (for example, by polling it, or with a callback from
+`Future.add_done_callback()` which wakes the loop up).
+
+Clients are not safe to share between threads, so each worker thread opens
+its own client, and only uses that.  Results and documents are copied into
+DetachedResults and DetachedDocuments in the worker thread, so nothing
+returned to the caller refers to the worker's client or database.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import logging
+import Queue
+import sys
+import threading
+import time
+
+import multisearch.document
+import multisearch.errors
+
+log = logging.getLogger(__name__)
+
+class Future(object):
+    """The result of a call which is being run by a SearchExecutor.
+
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """Return True if the call has finished.
+
+        """
+        return self._done.is_set()
+
+    def _wait(self, timeout):
+        """Wait for the call to finish.
+
+        Raises multisearch.errors.TimeoutError if it doesn't finish within
+        `timeout` seconds (or ever, if `timeout` is None).
+
+        """
+        if not self._done.wait(timeout):
+            raise multisearch.errors.TimeoutError(
+                "Call didn't finish within %r seconds" % (timeout, ))
+
+    def result(self, timeout=None):
+        """Get the value returned by the call, waiting for it if necessary.
+
+        If the call raised an exception, that exception is raised.
+
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Get the exception raised by the call, or None if it succeeded.
+
+        """
+        self._wait(timeout)
+        if self._exc_info is None:
+            return None
+        return self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        """Arrange for fn(future) to be called when the call finishes.
+
+        The callback is called in the worker thread which ran the call, or
+        immediately, in the calling thread, if the call has already finished.
+
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result, exc_info):
+        """Record the outcome of the call, and run the callbacks.
+
+        """
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                # An error in one callback mustn't stop the others, or kill
+                # the worker thread.
+                pass
+
+def _detach(item):
+    """Detach a document from its client; other items are returned as is.
+
+    """
+    if isinstance(item, multisearch.document.Document):
+        return item.detach()
+    return item
+
+class DetachedResults(object):
+    """A copy of a set of search results, made by SearchExecutor.search().
+
+    This holds the result items (DetachedDocuments, IDs or (docid, data)
+    pairs, according to the result mode of the search), and the other
+    properties of the results, but no references to the client or database
+    they came from.
+
+    """
+    def __init__(self, results):
+        self.items = [_detach(item) for item in results]
+        self.start_rank = results.start_rank
+        self.end_rank = results.end_rank
+        self.cursor = results.cursor
+        self.matches_lower_bound = results.matches_lower_bound
+        self.matches_estimated = results.matches_estimated
+        self.matches_upper_bound = results.matches_upper_bound
+        self.timed_out = getattr(results, 'timed_out', False)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def documents(self):
+        """Get a list of all the results.
+
+        """
+        return list(self.items)
+
+    def at_rank(self, rank):
+        if self.start_rank > rank or self.end_rank <= rank:
+            raise IndexError("result requested at rank %d, which is outside "
+                             "the calculated range of %d-%d" %
+                             (rank, self.start_rank, self.end_rank - 1))
+        return self.items[rank - self.start_rank]
+
+class SearchExecutor(object):
+    """Run calls to clients in a bounded pool of threads.
+
+    `open_client` is a callable which returns a new client.  Each of the
+    `workers` threads calls it when it is first given some work, and uses
+    the client it returns for all its calls.  The clients are closed when
+    the executor is closed.
+
+    If `max_queued` is not None, at most that many calls may be waiting for a
+    free thread: further calls are rejected with ExecutorBusyError, rather
+    than making the queue (and the time taken to reply) grow without limit.
+
+    Statistics about the calls made are available from `stats()`.
+
+    """
+    def __init__(self, open_client, workers=4, max_queued=None):
+        if workers < 1:
+            raise ValueError("An executor needs at least one worker thread")
+        self.open_client = open_client
+        self.workers = workers
+        self.max_queued = max_queued
+
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._closed = False
+
+        # Number of calls waiting for a thread, and being run.
+        self.queued = 0
+        self.active = 0
+
+        # Counts of calls submitted, finished (successfully or not), and
+        # rejected because the queue was full.
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+        # Total and longest times, in seconds, that calls waited for a
+        # thread, and total time spent running calls.
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.run_time = 0.0
+
+        self._threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._worker,
+                                      name="SearchExecutor-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        """Call fn(client, *args, **kwargs) in a worker thread.
+
+        `client` is the worker thread's client.  Returns a Future for the
+        value returned by the call.  The call must not return anything which
+        refers to the client or its database (such as a document or a set of
+        results: return a copy made with DetachedResults or
+        Document.detach() instead), since the client may be in use by
+        another call by then.
+
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise multisearch.errors.SearchClientError(
+                    "Executor has been closed")
+            if self.max_queued is not None and \
+               self.queued >= self.max_queued:
+                self.rejected += 1
+                raise multisearch.errors.ExecutorBusyError(
+                    "Executor already has %d calls queued" % self.queued)
+            self.queued += 1
+            self.submitted += 1
+        self._queue.put((future, fn, args, kwargs, time.time()))
+        return future
+
+    def search(self, search):
+        """Perform a search in a worker thread.
+
+        `search` is a multisearch.queries.Search.  Returns a Future for a
+        DetachedResults holding the results.  The search's parameters are
+        copied when this is called, but the query objects are not, so they
+        mustn't be used by other threads until the search has finished.
+
+        """
+        query = search.query
+        params = dict(search.params)
+        return self.submit(lambda client:
+                           DetachedResults(client.search(query, params)))
+
+    def count(self, search, exact=False):
+        """Count the documents matching a search, in a worker thread.
+
+        Returns a Future for the multisearch.queries.MatchCount.  See
+        Search.count() for the meaning of `exact`.
+
+        """
+        query = search.query
+        params = dict(search.params)
+        return self.submit(lambda client: client.count(query, params, exact))
+
+    def get_document(self, docid):
+        """Get a document, given a document ID, in a worker thread.
+
+        Returns a Future for a DetachedDocument (the Future raises KeyError
+        if the document does not exist).
+
+        """
+        return self.submit(lambda client:
+                           client.get_document(docid).detach())
+
+    def get_documents(self, docids):
+        """Get several documents, given a sequence of IDs, in a worker thread.
+
+        Returns a Future for a list of DetachedDocuments, with None in place
+        of any documents which do not exist, as for client.get_documents().
+
+        """
+        docids = list(docids)
+        return self.submit(lambda client:
+                           [None if doc is None else doc.detach()
+                            for doc in client.get_documents(docids)])
+
+    def _worker(self):
+        """Run calls from the queue, until told to stop.
+
+        """
+        client = None
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                future, fn, args, kwargs, submitted = item
+                started = time.time()
+                waited = started - submitted
+                with self._lock:
+                    self.queued -= 1
+                    self.active += 1
+                    self.queue_time += waited
+                    if waited > self.max_queue_time:
+                        self.max_queue_time = waited
+
+                result = exc_info = None
+                try:
+                    if client is None:
+                        client = self.open_client()
+                    result = fn(client, *args, **kwargs)
+                except Exception:
+                    exc_info = sys.exc_info()
+
+                with self._lock:
+                    self.active -= 1
+                    self.run_time += time.time() - started
+                    if exc_info is None:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                future._finish(result, exc_info)
+                # Don't keep the last result alive while waiting for work.
+                del item, future, result, exc_info
+        finally:
+            if client is not None:
+                try:
+                    client.close()
+                except Exception:
+                    log.exception("Error closing client in %s",
+                                  threading.current_thread().name)
+
+    def close(self, wait=True):
+        """Stop the worker threads, and close their clients.
+
+        Calls which have already been submitted are run first.  If `wait` is
+        True, waits for them to finish, and for the threads to stop.
+
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for thread in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def stats(self):
+        """Get a dictionary of statistics about the calls made.
+
+        """
+        with self._lock:
+            return dict(workers=self.workers, queued=self.queued,
+                        active=self.active, submitted=self.submitted,
+                        completed=self.completed, failed=self.failed,
+                        rejected=self.rejected, queue_time=self.queue_time,
+                        max_queue_time=self.max_queue_time,
+                        run_time=self.run_time)
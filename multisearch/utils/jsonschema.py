@@ -55,6 +55,11 @@ class JsonSchema(object):
         # has been saved.
         self.modified = False
 
+        # Counter which is incremented whenever the schema is modified.  This
+        # can be used to invalidate anything cached which was derived from the
+        # schema.
+        self.revision = 0
+
         # Flag to indicate when the schema is modifiable.
         # Some backends will set this to False.
         self.modifiable = True
@@ -67,6 +72,13 @@ class JsonSchema(object):
             raise errors.DbReadOnlyError("Attempt to modify schema for a "
                                          "readonly backend")
 
+    def mark_modified(self):
+        """Record that the schema has been modified.
+
+        """
+        self.modified = True
+        self.revision += 1
+
     def get(self, fieldname):
         """Get the field type and parameters.
 
@@ -90,7 +102,7 @@ class JsonSchema(object):
             # No change - just return
             return
         self.fieldtypes[fieldname] = (type, params)
-        self.modified = True
+        self.mark_modified()
 
     def get_route(self, incoming_field):
         """Get the route for an incoming field.
@@ -117,6 +129,7 @@ class JsonSchema(object):
         self.check_modifiable()
         if isinstance(dest_fields, basestring):
             self.routes[incoming_field] = ((dest_fields, {}), )
+            self.mark_modified()
             return
 
         route = []
@@ -127,7 +140,7 @@ class JsonSchema(object):
             dest_field, params = item
             route.append((dest_field, dict(params)))
         self.routes[incoming_field] = tuple(route)
-        self.modified = True
+        self.mark_modified()
 
     def guess(self, fieldname, value):
         """Guess the route, type and parameters for a field, given its value.
@@ -150,12 +163,12 @@ class JsonSchema(object):
         """
         self.check_modifiable()
         self.guessers.append(guesser)
-        self.modified = True
+        self.mark_modified()
 
     def clear_guessers(self):
         self.check_modifiable()
         self.guessers = []
-        self.modified = True
+        self.mark_modified()
 
     def fields_of_type(self, type):
         """Get a list of the fieldnames for all fields of the given type.
@@ -72,6 +72,16 @@ class LazyJsonObject(object):
         self._dump()
         return self._json
 
+    @property
+    def data(self):
+        """Get the data, decoding it from JSON the first time it's needed.
+
+        The result is shared with the object, so must not be modified.
+
+        """
+        self._load()
+        return self._data
+
     def copy_data(self):
         """Get a (deep) copy of the data in the object."""
         self._load()
@@ -0,0 +1,104 @@
+# Copyright (c) 2010 Richard Boulton
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+r"""A least-recently-used cache, bounded by entry count and size.
+
+"""
+__docformat__ = "restructuredtext en"
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    """A cache which discards the least recently used entries when full.
+
+    The cache holds at most `max_entries` entries, and, if `max_bytes` is not
+    None, entries whose sizes add up to at most `max_bytes`.  The size of each
+    entry is supplied by the caller when it is added.
+
+    Counts of hits, misses and evictions are kept in the `hits`, `misses` and
+    `evictions` attributes.
+
+    """
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        """Remove all entries from the cache.
+
+        """
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """Get the value for a key, or `default` if the key isn't cached.
+
+        """
+        try:
+            value, size = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = (value, size)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size=0):
+        """Add an entry to the cache, replacing any existing entry for the key.
+
+        Entries which are too large to fit in the cache at all are not added.
+
+        """
+        self.discard(key)
+        if self.max_entries <= 0 or \
+           (self.max_bytes is not None and size > self.max_bytes):
+            return
+        self.entries[key] = (value, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or \
+              (self.max_bytes is not None and self.bytes > self.max_bytes):
+            oldkey, (oldvalue, oldsize) = self.entries.popitem(last=False)
+            self.bytes -= oldsize
+            self.evictions += 1
+
+    def discard(self, key):
+        """Remove the entry for a key, if there is one.
+
+        """
+        item = self.entries.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def stats(self):
+        """Get a dictionary of statistics about the cache.
+
+        """
+        return dict(entries=len(self.entries), bytes=self.bytes,
+                    hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
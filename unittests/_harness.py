@@ -73,12 +73,14 @@ class MultiSearchTestCase(unittest.TestCase):
         if os.path.exists(self.tmpdir):
             shutil.rmtree(self.tmpdir)
 
-    def client(self, backend, readonly=False, dbnum=1):
+    def client(self, backend, readonly=False, dbnum=1, **kwargs):
         """Make a client.
 
+        Any extra keyword arguments are passed to the client factory.
+
         """
         dbname = "db%d" % dbnum
-        kwargs = dict(readonly=readonly)
+        kwargs['readonly'] = readonly
         if backend in ['xapian']:
             kwargs['path'] = os.path.join(self.tmpdir, dbname)
         elif backend in ['pyes']:
@@ -24,6 +24,8 @@ r"""Generic behaviour tests.
 __docformat__ = "restructuredtext en"
 
 from _harness import *
+import logging
+import time
 
 class GenericTest(MultiSearchTestCase):
     """Test generic search behaviours which should be the same across
@@ -91,6 +93,687 @@ class GenericTest(MultiSearchTestCase):
         id1 = client.update(indoc, docid=2)
         self.assertEqual(client.document_count, 2)
 
+    @with_backends
+    def test_update_many(self, backend):
+        """Test adding documents in bulk.
+
+        """
+        client = self.client(backend)
+        docs = [(1, {'title': 'one'}),
+                (None, {'title': 'two'}),
+                (3, {'title': 'three'})]
+        ids = list(client.update_many(docs))
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids[0], '1')
+        self.assertEqual(ids[2], '3')
+        self.assertEqual(client.document_count, 3)
+        self.assertEqual(client.get_document(ids[1]).data, {'title': ['two']})
+
+        ids = list(client.update_many([(3, {'title': 'four'})]))
+        self.assertEqual(ids, ['3'])
+        self.assertEqual(client.document_count, 3)
+        self.assertEqual(client.get_document('3').data, {'title': ['four']})
+
+        self.assertRaises(multisearch.errors.DocExistsError, list,
+                          client.update_many([(5, {'title': 'five'}),
+                                              (1, {'title': 'one'})],
+                                             fail_if_exists=True))
+        self.assertEqual(client.document_count, 3)
+
+    @with_backends('xapian')
+    def test_update_many_parallel(self, backend):
+        """Test processing documents in parallel when adding them in bulk.
+
+        """
+        client = self.client(backend, processes=2)
+        pool = client._pool.pool
+        docs = [(i % 7, {'title': 'doc %d' % i, 'text': 'number %d' % i})
+                for i in xrange(100)]
+        ids = list(client.update_many(docs, batch_size=5))
+        self.assertEqual(ids, [str(i % 7) for i in xrange(100)])
+        self.assertEqual(client.document_count, 7)
+        self.assertEqual(client.get_document('1').data,
+                         {'title': ['doc 99'], 'text': ['number 99']})
+        r = client.query(u'number', u'text').search(0, 10)
+        self.assertEqual(len(r), 7)
+
+        # The same pool is used for later calls.
+        ids = list(client.update_many([(7, {'title': 'doc 100'})]))
+        self.assertEqual(ids, ['7'])
+        self.assertTrue(client._pool.pool is pool)
+
+        # Closing the client stops the workers.
+        workers = list(pool._pool)
+        client.close()
+        self.assertEqual(client._pool.pool, None)
+        for worker in workers:
+            self.assertFalse(worker.is_alive())
+        client = self.client(backend)
+        self.assertEqual(client.document_count, 8)
+        client.close()
+
+    @with_backends('xapian')
+    def test_build_sharded(self, backend):
+        """Test building a database in parallel, as a set of shards.
+
+        """
+        from multisearch.backends.xapian_backend.build import build_sharded
+        docs = [(i, {'title': 'doc %d' % i, 'text': 'number %d' % i})
+                for i in xrange(50)]
+        for compact in (False, True):
+            path = os.path.join(self.tmpdir, 'built%s' % compact)
+            paths = build_sharded(path, docs, 3, compact=compact,
+                                  batch_size=7)
+            self.assertEqual(len(paths), 1 if compact else 3)
+            for shard_path in paths:
+                client = multisearch.SearchClient(backend, path=shard_path,
+                                                  readonly=True)
+                self.assertEqual(sorted(client.schema.fieldtypes),
+                                 ['', 'text', 'title'])
+            if compact:
+                self.assertEqual(client.document_count, 50)
+                self.assertEqual(client.get_document('7').data,
+                                 {'title': ['doc 7'], 'text': ['number 7']})
+
+    @with_backends('xapian')
+    def test_multiple_databases(self, backend):
+        """Test searching several databases together.
+
+        """
+        for dbnum in (1, 2):
+            client = self.client(backend, dbnum=dbnum)
+            client.update({'title': 'doc %d' % dbnum}, docid=dbnum)
+            client.close()
+        paths = [os.path.join(self.tmpdir, 'db%d' % dbnum)
+                 for dbnum in (1, 2)]
+        client = multisearch.SearchClient(backend, path=paths, readonly=True)
+        self.assertEqual(client.document_count, 2)
+        self.assertEqual(sorted(doc.docid for doc in client), ['1', '2'])
+        self.assertEqual(client.get_document('2').data,
+                         {'title': ['doc 2']})
+        r = client.query(u'doc').search(0, 10)
+        self.assertEqual(sorted(doc.docid for doc in r), ['1', '2'])
+
+        client = self.client(backend, dbnum=3)
+        client.schema.set('title', 'BLOB', {})
+        client.update({'title': 'doc 3'}, docid=3)
+        client.close()
+        paths.append(os.path.join(self.tmpdir, 'db3'))
+        self.assertRaises(multisearch.errors.SearchClientError,
+                          multisearch.SearchClient, backend, path=paths,
+                          readonly=True)
+        self.assertRaises(multisearch.errors.BackendError,
+                          multisearch.SearchClient, backend, path=paths)
+
+        # Schemas which use one value slot for different fields can't be
+        # merged.
+        from multisearch.backends.xapian_backend.client import Schema
+        def schema(fields):
+            schema = Schema()
+            for fieldname, slot in fields:
+                schema.set(fieldname, 'FLOAT', {'slot': slot})
+            return Schema.unserialise(schema.serialise())
+        self.assertRaises(multisearch.errors.SearchClientError, Schema.merge,
+                          [schema([('price', 0)]), schema([('weight', 0)])])
+        merged = Schema.merge([schema([('price', 0)]),
+                               schema([('price', 0), ('weight', 1)])])
+        self.assertEqual(merged.get('weight')[1], {'slot': 1})
+
+    @with_backends('xapian')
+    def test_result_cache(self, backend):
+        """Test caching of search results.
+
+        """
+        client = self.client(backend, result_cache_size=10)
+        client.update({'title': 'one'}, docid=1)
+        self.assertEqual(len(client.query(u'one').search(0, 10)), 1)
+        self.assertEqual(len(client.query(u'one').search(0, 10)), 1)
+        self.assertEqual(client.result_cache.hits, 1)
+        client.update({'title': 'one again'}, docid=2)
+        self.assertEqual(len(client.query(u'one').search(0, 10)), 2)
+        self.assertEqual(client.result_cache.hits, 1)
+        self.assertEqual(len(client.query(u'one').search(0, 1)), 1)
+        self.assertEqual(client.result_cache.stats()['entries'], 2)
+
+        # Each search gets its own Results, even when they come from the
+        # cache.
+        first = client.query(u'one').search(0, 10).results
+        second = client.query(u'one').search(0, 10).results
+        self.assertEqual(client.result_cache.hits, 3)
+        self.assertFalse(first is second)
+        self.assertEqual(sorted(doc.docid for doc in first),
+                         sorted(doc.docid for doc in second))
+
+        # Modifying the schema, even without writing any documents, empties
+        # the cache.
+        client.schema.alloc_slot()
+        self.assertEqual(len(client.query(u'one').search(0, 10)), 2)
+        self.assertEqual(client.result_cache.hits, 3)
+        self.assertEqual(client.result_cache.stats()['entries'], 1)
+
+    @with_backends('xapian')
+    def test_query_fields(self, backend):
+        """Test restricting the fields searched by the query parser.
+
+        """
+        client = self.client(backend)
+        client.update({'title': 'first', 'text': 'second'}, docid=1)
+        for i in range(2):
+            self.assertEqual(len(client.query(u'title:first').search(0, 10)), 1)
+            self.assertEqual(len(client.query(u'title:first',
+                                              allow='title').search(0, 10)), 1)
+        client.update({'title': 'first', 'author': 'third'}, docid=2)
+        self.assertEqual(len(client.query(u'author:third').search(0, 10)), 1)
+
+    @with_backends('xapian')
+    def test_query_deny(self, backend):
+        """Test excluding fields from those searched by the query parser.
+
+        """
+        client = self.client(backend)
+        client.update({'title': 'first', 'text': 'second'}, docid=1)
+        self.assertEqual(len(client.query(u'first').search(0, 10)), 1)
+        self.assertEqual(len(client.query(u'first',
+                                          deny='title').search(0, 10)), 0)
+        self.assertEqual(len(client.query(u'second',
+                                          deny='title').search(0, 10)), 1)
+        self.assertEqual(len(client.query(u'title:first',
+                                          deny='title').search(0, 10)), 0)
+
+    @with_backends('xapian')
+    def test_query_default_op(self, backend):
+        """Test the operator used to combine the words in a parsed query.
+
+        """
+        client = self.client(backend)
+        client.update({'title': 'one two'}, docid=1)
+        client.update({'title': 'one'}, docid=2)
+        self.assertEqual(len(client.query(u'one two').search(0, 10)), 1)
+        self.assertEqual(len(client.query(u'one two',
+            default_op=multisearch.Query.OR).search(0, 10)), 2)
+        self.assertEqual(len(client.query(u'one two',
+            default_op=multisearch.Query.AND).search(0, 10)), 1)
+
+    @with_backends('xapian')
+    def test_docid_slot(self, backend):
+        """Test reading document IDs from databases with and without a docid
+        slot.
+
+        """
+        client = self.client(backend)
+        client.schema.docid_slot = None
+        client.update({'title': 'one'}, docid=1)
+        client.close()
+
+        client = self.client(backend)
+        self.assertEqual(client.schema.docid_slot, None)
+        client.update({'title': 'two'}, docid=2)
+        self.assertEqual(sorted(doc.docid for doc in client), ['1', '2'])
+
+        # A migration refused because the schema can't be modified leaves
+        # the documents unchanged.
+        client.schema.modifiable = False
+        self.assertRaises(multisearch.errors.DbReadOnlyError,
+                          client.migrate_docid_slot)
+        self.assertEqual(client.schema.docid_slot, None)
+        for doc in client:
+            self.assertEqual(doc.raw.get_value(client.schema.DOCID_SLOT), '')
+        client.schema.modifiable = True
+
+        client.migrate_docid_slot(batch_size=1)
+        self.assertNotEqual(client.schema.docid_slot, None)
+        for doc in client:
+            self.assertEqual(doc.raw.get_value(client.schema.docid_slot),
+                             doc.docid)
+        client.close()
+
+        client = self.client(backend, readonly=True)
+        self.assertNotEqual(client.schema.docid_slot, None)
+        self.assertEqual([doc.docid for doc in client.query(u'two').search()],
+                         ['2'])
+
+    @with_backends
+    def test_result_modes(self, backend):
+        """Test returning only IDs or selected fields from a search.
+
+        """
+        client = self.client(backend)
+        client.update({'title': 'one', 'text': 'first'}, docid=1)
+        client.update({'title': 'two'}, docid=2)
+        search = client.query_all().search(0, 10)
+        self.assertEqual(sorted(search.ids_only()), ['1', '2'])
+        self.assertEqual(sorted(search.fields(['text'])),
+                         [('1', {'text': ['first']}), ('2', {})])
+        search = client.query_all().search(0, 10)
+        self.assertEqual(sorted(doc.docid for doc in search), ['1', '2'])
+
+    @with_backends('xapian')
+    def test_result_documents(self, backend):
+        """Test getting a whole page of results at once.
+
+        """
+        client = self.client(backend)
+        for i in xrange(5):
+            client.update({'title': 'doc %d' % i}, docid=i)
+        results = client.query(u'doc').search(0, 3).results
+        first = results.at_rank(1).docid
+        docs = results.documents()
+        self.assertEqual([doc.rank for doc in docs], [0, 1, 2])
+        self.assertEqual(docs[1].docid, first)
+        self.assertEqual([doc.docid for doc in docs],
+                         [results.at_rank(rank).docid for rank in (0, 1, 2)])
+        self.assertEqual(docs[0].data, {'title': ['doc ' + docs[0].docid]})
+
+    @with_backends('xapian')
+    def test_get_documents(self, backend):
+        """Test getting and checking for several documents at once.
+
+        """
+        client = self.client(backend)
+        for i in xrange(4):
+            client.update({'title': 'doc %d' % i}, docid=i)
+        docs = client.get_documents(['3', 'missing', '0', '3'])
+        self.assertEqual(docs[1], None)
+        self.assertEqual([doc.docid for doc in docs if doc is not None],
+                         ['3', '0', '3'])
+        self.assertEqual(docs[0].data, {'title': ['doc 3']})
+        self.assertEqual(client.get_documents([]), [])
+        self.assertEqual(client.document_exists_many(['2', 'missing', '1']),
+                         [True, False, True])
+
+    @with_backends('xapian')
+    def test_data_codec(self, backend):
+        """Test changing the codec used for stored data.
+
+        """
+        client = self.client(backend)
+        client.update({'title': 'old doc'}, docid=1)
+        client.close()
+        client = self.client(backend, data_codec='indexed-zlib')
+        self.assertEqual(client.schema.data_codec, 'indexed-zlib')
+        client.update({'title': 'new doc', 'tag': 'x'}, docid=2)
+        client.commit()
+        self.assertEqual(client.get_document('1').data, {'title': ['old doc']})
+        self.assertEqual(client.get_document('2').data,
+                         {'title': ['new doc'], 'tag': ['x']})
+        client.close()
+
+        client = self.client(backend, readonly=True)
+        self.assertEqual(client.schema.data_codec, 'indexed-zlib')
+        search = client.query(u'doc').search(0, 10)
+        self.assertEqual(sorted(search.fields(['tag'])),
+                         [('1', {}), ('2', {'tag': ['x']})])
+
+    @with_backends('xapian')
+    def test_lazy_data(self, backend):
+        """Test that stored data is parsed once, and only when needed.
+
+        """
+        client = self.client(backend, data_codec='indexed')
+        client.update({'title': 'one'}, docid=1)
+        doc = client.get_document('1')
+        self.assertEqual(multisearch.utils.json.loads(doc.data_json),
+                         {'title': ['one']})
+        self.assertEqual(doc.get_raw_data()[0],
+                         multisearch.utils.datacodec.INDEXED_MAGIC)
+        data = doc.data
+        self.assertEqual(data, {'title': ['one']})
+        self.assertTrue(doc.data is data)
+        copied = doc.copy_data()
+        copied['title'].append('two')
+        self.assertEqual(doc.data, {'title': ['one']})
+
+    @with_backends('xapian')
+    def test_query_canonical(self, backend):
+        """Test comparing and hashing queries by their structure.
+
+        """
+        client = self.client(backend)
+        client.update({'title': 'one', 'text': 'first'}, docid=1)
+        q1 = client.query(u'one', allow='title')
+        q2 = client.query(u'one', allow=['title'])
+        q3 = client.query(u'first')
+        self.assertEqual(q1, q2)
+        self.assertEqual(hash(q1), hash(q2))
+        self.assertNotEqual(q1, q3)
+        self.assertEqual(q1 | q3, q3 | q2)
+        self.assertEqual((q1 & q3).fingerprint(), (q3 & q2).fingerprint())
+        self.assertNotEqual(q1 - q3, q3 - q1)
+        self.assertEqual(q1 * 2, q2 * 2.0)
+        self.assertNotEqual(q1 * 2, q1 * 3)
+        self.assertEqual(len(set([q1, q2, q3, client.query_all(),
+                                  client.query_all()])), 3)
+        self.assertEqual(multisearch.utils.json.loads((q1 | q3).serialise()),
+                         multisearch.utils.json.loads((q3 | q1).serialise()))
+
+    @with_backends('xapian')
+    def test_query_optimise(self, backend):
+        """Test simplifying query trees before they're compiled.
+
+        """
+        client = self.client(backend)
+        client.update({'title': 'one two', 'text': 'first'}, docid=1)
+        client.update({'title': 'two', 'text': 'second'}, docid=2)
+        one = client.query(u'one')
+        two = client.query(u'two')
+        first = client.query(u'first')
+        q = ((one & client.query_all()) & (two & first)).optimise()
+        self.assertEqual(q.op, q.AND)
+        self.assertEqual(len(q.subqs), 3)
+        self.assertTrue(q.conn is client)
+        q = (one | (client.query_none() | two)).optimise()
+        self.assertEqual(q, one | two)
+        self.assertEqual((one & (two & client.query_none())).optimise().op,
+                         q.NONE)
+        self.assertEqual(((one * 2) * 3).optimise(), one * 6)
+        self.assertTrue(((one * 2) * 0.5).optimise() is one)
+        x = one - two
+        self.assertTrue(x.optimise() is x)
+
+        q = client.query_all()
+        for word in (u'one', u'two', u'first') * 100:
+            q = q & client.query(word)
+        self.assertEqual(len(q.optimise().subqs), 300)
+        self.assertEqual([doc.docid for doc in q.search(0, 10)], ['1'])
+
+    @with_backends('xapian')
+    def test_filter(self, backend):
+        """Test filtering queries without affecting their weights.
+
+        """
+        client = self.client(backend)
+        client.update({'title': 'one two', 'text': 'first'}, docid=1)
+        client.update({'title': 'two', 'text': 'second'}, docid=2)
+        two = client.query(u'two')
+        first = client.query(u'first')
+
+        weights = dict((client._get_docid(item.document), item.weight)
+                       for item in two.search(0, 10).results.mset)
+        for search in (two.filter(first).search(0, 10),
+                       two.search(0, 10).filter(first),
+                       two.search(0, 10).filter(first * 5)):
+            self.assertEqual([doc.docid for doc in search], ['1'])
+            self.assertEqual([item.weight for item in search.results.mset],
+                             [weights['1']])
+        self.assertEqual(two.filter(first).filter(client.query_all())
+                         .optimise(), two.filter(first))
+        self.assertEqual(len(two.search(0, 10)
+                             .filter(client.query_none())), 0)
+
+    @with_backends('xapian')
+    def test_filter_cache(self, backend):
+        """Test reusing the sets of documents matching filters.
+
+        """
+        from multisearch.backends.xapian_backend.filtercache import DocidSet
+        for docids in ([3, 9, 200], range(1, 200, 2)):
+            s = DocidSet(docids, 200)
+            self.assertEqual(len(s), len(docids))
+            self.assertTrue(docids[1] in s)
+            self.assertFalse(docids[1] + 1 in s)
+            self.assertEqual(s.next_from(docids[0] + 1), docids[1])
+            self.assertEqual(s.next_from(docids[-1]), docids[-1])
+            self.assertEqual(s.next_from(docids[-1] + 1), None)
+
+        client = self.client(backend, filter_cache_size=4)
+        for i in xrange(10):
+            client.update({'title': 'doc %d' % i,
+                           'cat': 'odd' if i % 2 else 'even'}, docid=i)
+        odd = client.query(u'odd', allow='cat')
+        odd_or_four = odd | client.query(u'4', allow='title')
+        expected = ['1', '3', '4', '5', '7', '9']
+        for i in xrange(3):
+            search = client.query(u'doc').search(0, 10).filter(odd_or_four)
+            self.assertEqual(sorted(doc.docid for doc in search), expected)
+        self.assertEqual(client.filter_cache.stats()['entries'], 1)
+        # Filters which are a single term aren't cached.
+        for i in xrange(3):
+            search = client.query(u'doc').search(0, 10).filter(odd)
+            self.assertEqual(len(search), 5)
+        self.assertEqual(client.filter_cache.stats()['entries'], 1)
+
+        # Sets are built in batches.
+        client.FILTER_BATCH_SIZE = 2
+        client.filter_cache.clear()
+        for i in xrange(2):
+            search = client.query(u'doc').search(0, 10).filter(odd_or_four)
+            self.assertEqual(sorted(doc.docid for doc in search), expected)
+        client.update({'title': 'doc 11', 'cat': 'odd'}, docid=11)
+        self.assertEqual(client.filter_cache.stats()['entries'], 0)
+
+    @with_backends('xapian')
+    def test_search_after(self, backend):
+        """Test paging through results with cursors.
+
+        """
+        client = self.client(backend)
+        client.schema.set('group', 'BLOB', {'slot': client.schema.alloc_slot()})
+        # Documents with no group ("-") sort before all the others in
+        # ascending order, and after them in descending order.
+        for i, group in enumerate('aa-abb-cdd-dd'):
+            if group == '-':
+                client.update({'title': 'doc'}, docid=i)
+            else:
+                client.update({'title': 'doc', 'group': group}, docid=i)
+
+        for order in ('+group', '-group', None):
+            search = client.query(u'doc').search(0, 20)
+            if order is not None:
+                search.order_by(order)
+            expected = [doc.docid for doc in search]
+            self.assertEqual(len(expected), 13)
+
+            pages = []
+            cursor = None
+            while True:
+                search = client.query(u'doc').search(0, 3).search_after(cursor)
+                if order is not None:
+                    search.order_by(order)
+                page = search.results
+                if len(page) == 0:
+                    break
+                pages.append([(doc.rank, doc.docid) for doc in page])
+                cursor = page.cursor
+            self.assertEqual([len(page) for page in pages], [3, 3, 3, 3, 1])
+            self.assertEqual([item for page in pages for item in page],
+                             list(enumerate(expected)))
+
+        search = client.query(u'doc').search(0, 3).order_by('+group')
+        search.search_after(client.query(u'doc').search(0, 3).results.cursor)
+        self.assertRaises(multisearch.errors.SearchClientError, len, search)
+
+    @with_backends('xapian')
+    def test_scan(self, backend):
+        """Test iterating through all the results of a search in batches.
+
+        """
+        client = self.client(backend)
+        for i in xrange(10):
+            client.update({'title': 'doc %d' % i,
+                           'cat': 'odd' if i % 2 else 'even'}, docid=i)
+        client.update({'title': 'other'}, docid=10)
+
+        batches = list(client.query(u'doc').search(0, 1).scan(3))
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 3, 1])
+        self.assertEqual(sorted(doc.docid for batch in batches
+                                for doc in batch),
+                         sorted(str(i) for i in xrange(10)))
+
+        search = client.query(u'doc').search(0, 1).ids_only()
+        search.filter(client.query(u'odd', allow='cat'))
+        self.assertEqual(sorted(docid for batch in search.scan(2)
+                                for docid in batch),
+                         ['1', '3', '5', '7', '9'])
+        self.assertEqual(list(client.query_none().search().scan(2)), [])
+
+    @with_backends('xapian')
+    def test_count(self, backend):
+        """Test counting the matches for a search.
+
+        """
+        client = self.client(backend, result_cache_size=10)
+        for i in xrange(10):
+            client.update({'title': 'doc %d' % i,
+                           'cat': 'odd' if i % 2 else 'even'}, docid=i)
+        search = client.query(u'doc').search(0, 1)
+        for exact in (True, 5, False):
+            count = search.count(exact)
+            self.assertTrue(count.lower_bound <= count.estimated <=
+                            count.upper_bound)
+        count = search.count(exact=True)
+        self.assertTrue(count.exact)
+        self.assertEqual(int(count), 10)
+        self.assertTrue(search.count(exact=True) is count)
+        self.assertTrue(search.count(5).lower_bound >= 5)
+
+        search.filter(client.query(u'odd', allow='cat'))
+        self.assertEqual(int(search.count(exact=True)), 5)
+        self.assertEqual(int(client.query_none().search().count(True)), 0)
+
+    @with_backends('xapian')
+    def test_time_limits(self, backend):
+        """Test setting time limits for searches.
+
+        """
+        client = self.client(backend, result_cache_size=10, default_timeout=60)
+        client.update({'title': 'doc'}, docid=1)
+        self.assertEqual(client._time_limit({}), 60)
+        self.assertEqual(client._time_limit({'timeout': 5}), 5)
+        self.assertTrue(client._time_limit({'deadline': time.time() + 1,
+                                            'timeout': 5}) <= 1)
+        self.assertEqual(client._time_limit({'deadline': time.time() - 1}),
+                         client.MIN_TIME_LIMIT)
+        client.default_timeout = None
+        self.assertEqual(client._time_limit({}), None)
+
+        results = client.query(u'doc').search().timeout(30).results
+        self.assertFalse(results.timed_out)
+        self.assertEqual([doc.docid for doc in results], ['1'])
+        # Results which weren't cut short are reused whatever the time limit.
+        hits = client.result_cache.hits
+        search = client.query(u'doc').search().deadline(time.time() + 30)
+        self.assertEqual([doc.docid for doc in search], ['1'])
+        self.assertEqual(client.result_cache.hits, hits + 1)
+
+        # A search which is already past its deadline is cut short as soon
+        # as the match starts.
+        for i in xrange(2, 21):
+            client.update({'title': 'doc'}, docid=i)
+        client.MIN_TIME_LIMIT = 0
+        search = client.query(u'doc').search(0, 30).deadline(time.time() - 1)
+        self.assertTrue(search.results.timed_out)
+        self.assertTrue(len(search) < 20)
+        # Results which were cut short aren't cached.
+        search = client.query(u'doc').search(0, 30)
+        self.assertFalse(search.results.timed_out)
+        self.assertEqual(len(search), 20)
+        client.close()
+
+        # Time limits can't be applied when searching multiple databases.
+        other = self.client(backend, dbnum=2)
+        other.update({'title': 'doc'}, docid=21)
+        other.close()
+        paths = [os.path.join(self.tmpdir, 'db%d' % dbnum)
+                 for dbnum in (1, 2)]
+        self.assertRaises(multisearch.errors.FeatureNotAvailableError,
+                          multisearch.SearchClient, backend, path=paths,
+                          readonly=True, default_timeout=5)
+        client = multisearch.SearchClient(backend, path=paths, readonly=True)
+        search = client.query(u'doc').search().timeout(5)
+        self.assertRaises(multisearch.errors.FeatureNotAvailableError, len,
+                          search)
+
+    @with_backends('xapian')
+    def test_executor(self, backend):
+        """Test searching and fetching documents with a SearchExecutor.
+
+        """
+        client = self.client(backend)
+        for i in range(5):
+            client.update({'title': 'doc %d' % i}, docid=i)
+        client.commit()
+
+        opened = []
+        def open_client():
+            opened.append(self.client(backend, readonly=True))
+            return opened[-1]
+        executor = multisearch.utils.SearchExecutor(open_client, workers=2,
+                                                    max_queued=10)
+        search = client.query(u'doc').search(0, 3)
+        results = executor.search(search).result(10)
+        self.assertEqual(len(results), 3)
+        # The results hold copies of the documents, not the worker's MSet.
+        self.assertFalse(hasattr(results, 'mset'))
+        self.assertTrue(isinstance(results.at_rank(0),
+                                   multisearch.DetachedDocument))
+        self.assertEqual([(doc.rank, doc.docid) for doc in results],
+                         [(doc.rank, doc.docid) for doc in search])
+        self.assertEqual(results.matches_estimated, 5)
+        self.assertFalse(results.timed_out)
+        self.assertEqual(results.cursor, search.results.cursor)
+        ids = executor.search(client.query(u'doc').search(0, 3).ids_only())
+        self.assertEqual(list(ids.result(10)), [doc.docid for doc in search])
+        self.assertEqual(int(executor.count(search, exact=True).result(10)),
+                         5)
+
+        doc = executor.get_document('2').result(10)
+        self.assertEqual(doc.docid, '2')
+        self.assertEqual(doc.data, {'title': ['doc 2']})
+        self.assertRaises(multisearch.errors.FeatureNotAvailableError,
+                          getattr, doc, 'terms')
+        self.assertRaises(KeyError, executor.get_document('9').result, 10)
+        docs = executor.get_documents(['1', '9']).result(10)
+        self.assertEqual(docs[0].docid, '1')
+        self.assertEqual(docs[1], None)
+
+        stats = executor.stats()
+        self.assertEqual(stats['submitted'], 6)
+        self.assertEqual(stats['failed'], 1)
+        # Closing the executor closes each worker's (readonly) client,
+        # without errors.
+        errors = []
+        handler = logging.Handler()
+        handler.emit = errors.append
+        logger = logging.getLogger('multisearch.utils.executor')
+        logger.addHandler(handler)
+        try:
+            executor.close()
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(errors, [])
+        self.assertTrue(opened)
+        for worker_client in opened:
+            self.assertTrue(isinstance(worker_client.db,
+                                       multisearch.utils.closed.ClosedObject))
+        client.close()
+
+    @with_backends('xapian')
+    def test_append_only(self, backend):
+        """Test adding documents which are assumed to be new.
+
+        """
+        client = self.client(backend, append_only=True)
+        ids = list(client.update_many((None, {'title': 'doc %d' % i})
+                                      for i in xrange(10)))
+        self.assertEqual(len(set(ids)), 10)
+        client.update({'title': 'one'}, docid=1)
+        self.assertEqual(client.document_count, 11)
+        self.assertEqual(client.get_document('1').data, {'title': ['one']})
+
+    @with_backends('xapian')
+    def test_schema_changes(self, backend):
+        """Test that schema changes are seen by subsequent updates.
+
+        """
+        client = self.client(backend)
+        client.update({'title': 'one', 'text': 'first'}, docid=1)
+        client.schema.set_route('title', 'text')
+        client.update([('title', 'two'), ('text', 'second')], docid=2)
+        self.assertEqual(client.get_document('1').data,
+                         {'title': ['one'], 'text': ['first']})
+        self.assertEqual(client.get_document('2').data,
+                         {'text': ['two', 'second']})
+
     def test_invalid_backends(self):
         self.assertRaises(ImportError, self.client, 'unknown')
         self.assertRaises(ImportError, self.client, '!invalid')
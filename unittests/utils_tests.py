@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
-from multisearch import utils
+import logging
+import multisearch
+from multisearch import errors, utils
+import threading
+import time
 import unittest
 
 class UtilsTest(unittest.TestCase):
@@ -35,5 +39,229 @@ class LazyJsonObjectTest(unittest.TestCase):
         self.assertEqual(obj.copy_data(), {"hi": 2, "hello": 3})
         self.assertEqual(utils.json.loads(obj.json), {"hi": 2, "hello": 3})
 
+    def test_lazy_load(self):
+        """Test that a LazyJsonObject only parses its JSON when needed.
+
+        """
+        obj = utils.LazyJsonObject(json='{"a":[1]}')
+        self.assertEqual(obj.json, '{"a":[1]}')
+        self.assertEqual(obj._data, None)
+        data = obj.data
+        self.assertEqual(data, {"a": [1]})
+        self.assertTrue(obj.data is data)
+
+class DocidAllocatorTest(unittest.TestCase):
+    def test_abstract(self):
+        """Test that allocators without a __call__ method can't be created.
+
+        """
+        class Incomplete(utils.DocidAllocator):
+            unique = True
+        self.assertRaises(TypeError, utils.DocidAllocator)
+        self.assertRaises(TypeError, Incomplete)
+        self.assertFalse(utils.RandomDocidAllocator().unique)
+
+    def test_sequential(self):
+        """Test the sequential docid allocator.
+
+        """
+        alloc = utils.SequentialDocidAllocator('w1-', start=9, width=4)
+        self.assertTrue(alloc.unique)
+        self.assertEqual([alloc() for i in range(3)],
+                         ['w1-0009', 'w1-000a', 'w1-000b'])
+
+    def test_time_ordered(self):
+        """Test the time ordered docid allocator.
+
+        """
+        alloc = utils.TimeOrderedDocidAllocator(node='n1')
+        self.assertTrue(alloc.unique)
+        ids = [alloc() for i in range(1000)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertTrue(all(docid.endswith('n1') for docid in ids))
+        self.assertNotEqual(utils.TimeOrderedDocidAllocator().node,
+                            utils.TimeOrderedDocidAllocator().node)
+
+class CommitPolicyTest(unittest.TestCase):
+    def test_limits(self):
+        """Test the document and byte limits of a commit policy.
+
+        """
+        policy = utils.CommitPolicy(max_docs=3)
+        self.assertFalse(policy.measures_bytes)
+        self.assertEqual([policy.record() for i in range(3)],
+                         [False, False, True])
+        policy.reset()
+        self.assertFalse(policy.record())
+
+        policy = utils.CommitPolicy(max_bytes=100)
+        self.assertTrue(policy.measures_bytes)
+        self.assertFalse(policy.record(1, 60))
+        self.assertTrue(policy.record(1, 60))
+
+        policy = utils.CommitPolicy(max_seconds=0)
+        self.assertTrue(policy.record())
+
+    def test_doc_size(self):
+        """Test calculating the size of a document.
+
+        """
+        self.assertEqual(utils.doc_size({'title': 'hello'}), 10)
+        self.assertEqual(utils.doc_size([('a', ['bc', 'd']), ('e', 1.5)]), 8)
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        """Test eviction from an LRU cache by entry count and size.
+
+        """
+        cache = utils.LRUCache(2, max_bytes=10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3, 4)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('d', 4, 8)
+        self.assertEqual(sorted(cache.entries), ['d'])
+        cache.put('e', 5, 11)
+        self.assertFalse('e' in cache)
+        self.assertEqual(cache.stats(), dict(entries=1, bytes=8, hits=2,
+                                             misses=1, evictions=3))
+
+class DataCodecTest(unittest.TestCase):
+    def test_codecs(self):
+        """Test encoding and decoding stored data with each codec.
+
+        """
+        data = {u'title': [u'caf\xe9', u'two'], u'price': [1.5],
+                u'misc': [1, None, {u'a': [2]}], u'empty': []}
+        for codec in utils.datacodec.CODECS:
+            raw = utils.encode_data(data, codec)
+            self.assertEqual(utils.decode_data(raw), data)
+            self.assertEqual(utils.decode_fields(raw, [u'price', u'missing']),
+                             {u'price': [1.5]})
+            self.assertEqual(utils.decode_fields(raw, ['misc', u'title']),
+                             {'misc': data[u'misc'], u'title': data[u'title']})
+        self.assertEqual(utils.encode_data(data),
+                         utils.json.dumps(data, separators=(',', ':')))
+        self.assertEqual(utils.decode_data(''), {})
+        for codec in utils.datacodec.CODECS:
+            raw = utils.encode_data(data, codec)
+            self.assertEqual(utils.json.loads(utils.data_json(raw)), data)
+        self.assertRaises(ValueError, utils.encode_data, data, 'nonesuch')
+
+class ExecutorTest(unittest.TestCase):
+    class Client(object):
+        """A stand-in for a client, recording the thread it's used in.
+
+        """
+        def __init__(self):
+            self.closed = False
+            self.threads = set()
+        def close(self):
+            self.closed = True
+
+    def test_calls(self):
+        """Test running calls in a SearchExecutor.
+
+        """
+        clients = []
+        def open_client():
+            client = self.Client()
+            clients.append(client)
+            return client
+        def call(client, value):
+            client.threads.add(threading.current_thread())
+            return value * 2
+        executor = utils.SearchExecutor(open_client, workers=2)
+        futures = [executor.submit(call, i) for i in range(20)]
+        self.assertEqual([future.result(5) for future in futures],
+                         range(0, 40, 2))
+        self.assertTrue(1 <= len(clients) <= 2)
+        for client in clients:
+            self.assertEqual(len(client.threads), 1)
+
+        future = executor.submit(lambda client: {}['missing'])
+        self.assertRaises(KeyError, future.result, 5)
+        self.assertTrue(isinstance(future.exception(), KeyError))
+        done = []
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future])
+
+        stats = executor.stats()
+        self.assertEqual(stats['submitted'], 21)
+        self.assertEqual(stats['completed'], 20)
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['queued'], 0)
+        executor.close()
+        self.assertTrue(all(client.closed for client in clients))
+        self.assertRaises(errors.SearchClientError, executor.submit, call, 1)
+
+    def test_queue_limit(self):
+        """Test that a SearchExecutor rejects calls when its queue is full.
+
+        """
+        release = threading.Event()
+        executor = utils.SearchExecutor(self.Client, workers=1, max_queued=1)
+        busy = executor.submit(lambda client: release.wait(5))
+        # Wait for the worker to take the first call from the queue.
+        while executor.stats()['active'] == 0:
+            time.sleep(0.001)
+        queued = executor.submit(lambda client: 1)
+        self.assertRaises(errors.ExecutorBusyError, executor.submit,
+                          lambda client: 2)
+        self.assertRaises(errors.TimeoutError, queued.result, 0.01)
+        release.set()
+        self.assertEqual(queued.result(5), 1)
+        self.assertTrue(busy.done())
+        self.assertEqual(executor.stats()['rejected'], 1)
+        executor.close()
+
+    def test_close_errors(self):
+        """Test that errors closing clients don't escape from worker threads.
+
+        """
+        class Client(self.Client):
+            def close(self):
+                raise errors.FeatureNotAvailableError
+        logged = []
+        handler = logging.Handler()
+        handler.emit = logged.append
+        logger = logging.getLogger('multisearch.utils.executor')
+        logger.addHandler(handler)
+        try:
+            executor = utils.SearchExecutor(Client, workers=1)
+            self.assertEqual(executor.submit(lambda client: 1).result(5), 1)
+            executor.close()
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(len(logged), 1)
+
+    def test_detached_results(self):
+        """Test copying a set of results with DetachedResults.
+
+        """
+        class Results(object):
+            start_rank, end_rank = 5, 7
+            cursor = 'next'
+            matches_lower_bound = 2
+            matches_estimated = 3
+            matches_upper_bound = 4
+            items = [multisearch.DetachedDocument('1', '{"a":[1]}', 5),
+                     ('2', {})]
+            def __iter__(self):
+                return iter(self.items)
+        orig = Results()
+        results = utils.DetachedResults(orig)
+        self.assertEqual(len(results), 2)
+        # Documents are copied; other items are kept as they are.
+        doc = results.at_rank(5)
+        self.assertFalse(doc is orig.items[0])
+        self.assertEqual((doc.docid, doc.data, doc.rank), ('1', {'a': [1]}, 5))
+        self.assertEqual(results.at_rank(6), ('2', {}))
+        self.assertRaises(IndexError, results.at_rank, 7)
+        self.assertEqual((results.cursor, results.matches_estimated,
+                          results.timed_out), ('next', 3, False))
+
 if __name__ == '__main__':
     unittest.main()